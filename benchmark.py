@@ -0,0 +1,232 @@
+import os, sys, getopt, time, json, shutil, tempfile, subprocess, platform, sqlite3
+import logservatory
+
+# Reproducible benchmarks: generates logs with generate-logs.py, then measures build-index.py throughput,
+# ingest rate per format, query latency of the README example queries, live.py throughput, and peak memory
+# of historical.py against --memory. Results are printed (or written) as JSON, to compare between versions.
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+example_queries = {
+	'404s per second': """SELECT timestamp, COUNT(*)
+		FROM logs WHERE request_status_code='404'
+		GROUP BY timestamp""",
+	'search terms': """SELECT SUBSTR(request_url, INSTR(request_url, '/search?q=') + 10) AS term, COUNT(*)
+		FROM logs WHERE request_url LIKE '%/search?q=%'
+		GROUP BY term""", # (ELB request URLs start with the scheme and host)
+	'rate limit': """WITH results(ip, ts, n_reqs) AS (
+			SELECT request_ip, timestamp, count(*) OVER w
+			FROM logs
+			WINDOW w AS (
+				PARTITION BY request_ip
+				ORDER BY timestamp
+				RANGE BETWEEN 60 PRECEDING AND CURRENT ROW
+			)
+		) SELECT * FROM results WHERE n_reqs>30
+		GROUP BY ip, ts, n_reqs""",
+}
+
+
+def run(args, stdin=None, stdout=subprocess.DEVNULL):
+	# runs a command, returning (wall-clock seconds, peak RSS in bytes of the process itself). The peak
+	# is polled from /proc where there is one, since on Linux a child's ru_maxrss also counts the
+	# memory of this (parent) process at the time it was started.
+	started = time.monotonic()
+	p = subprocess.Popen([sys.executable] + args, stdin=stdin, stdout=stdout, cwd=here)
+	peak = 0
+	status = '/proc/' + str(p.pid) + '/status'
+	while True:
+		pid, code, usage = os.wait4(p.pid, os.WNOHANG)
+		if pid!=0: break
+		try:
+			with open(status) as f:
+				for line in f:
+					if line.startswith('VmHWM:'): peak = max(peak, int(line.split()[1]) * 1024)
+		except OSError:
+			pass
+		time.sleep(0.02)
+	seconds = time.monotonic() - started
+	if code!=0:
+		print('Benchmark command failed: ' + ' '.join(args))
+		exit()
+	if peak==0: peak = usage.ru_maxrss * 1024 if sys.platform!='darwin' else usage.ru_maxrss
+	return seconds, peak
+
+
+def directory_bytes(path):
+	return sum(os.path.getsize(os.path.join(root, name)) for root, dirs, files in os.walk(path) for name in files)
+
+
+def bench_index(fmt, logs, work, n_lines):
+	index = os.path.join(work, fmt + '-index.csv')
+	with open(index, 'w') as out:
+		seconds, rss = run(['build-index.py', '--input', logs, '--format', fmt], stdout=out)
+	return index, {'seconds': round(seconds, 3), 'lines_per_second': round(n_lines / seconds), 'bytes_per_second': round(directory_bytes(logs) / seconds)}
+
+
+def bench_ingest(fmt, logs, buffer_size):
+	# ingest_logs() in buffer-sized batches, in this process (parsing plus inserting)
+	lines = []
+	for name in sorted(os.listdir(logs)):
+		with open(os.path.join(logs, name), encoding=logservatory.encoding, errors='replace') as f:
+			lines.extend(f.readlines())
+	logservatory.format = fmt
+	logservatory.partition = 0
+	logservatory.prune = False # (measure storing every column)
+	logservatory.start_database()
+	started = time.monotonic()
+	for i in range(0, len(lines), buffer_size):
+		logservatory.buffer = lines[i:i+buffer_size]
+		logservatory.ingest_logs()
+	logservatory.connection.commit()
+	seconds = time.monotonic() - started
+	logservatory.buffer = []
+	rows = logservatory.get_db_stat('SELECT COUNT(*) FROM logs')
+	return {'seconds': round(seconds, 3), 'lines_per_second': round(len(lines) / seconds), 'rows': rows}
+
+
+def bench_queries(work):
+	# latency of each example query over the database bench_ingest() just loaded
+	output = os.path.join(work, 'query-output') + os.sep
+	os.makedirs(output, exist_ok=True)
+	logservatory.output = output
+	results = {}
+	for name, query in example_queries.items():
+		logservatory.queries = [query]
+		started = time.monotonic()
+		# (run_query() itself, since run_queries() in live mode reports a failing query and carries on)
+		try:
+			logservatory.run_query(0, 'live', (), logservatory.connection)
+		except Exception as e:
+			print('Benchmark query "' + name + '" failed: ' + str(e))
+			exit()
+		results[name] = round(time.monotonic() - started, 4)
+	return results
+
+
+def bench_live(fmt, logs, work, n_lines):
+	# live.py over the logs piped in as fast as it takes them (its queries run once, at the end)
+	queries = os.path.join(work, 'live-queries.sql')
+	with open(queries, 'w') as f:
+		f.write("SELECT request_status_code, COUNT(*) FROM logs GROUP BY request_status_code\n")
+	output = os.path.join(work, 'live-output') + os.sep
+	os.makedirs(output, exist_ok=True)
+	combined = os.path.join(work, fmt + '-all.log')
+	with open(combined, 'wb') as out:
+		for name in sorted(os.listdir(logs)):
+			with open(os.path.join(logs, name), 'rb') as f: shutil.copyfileobj(f, out)
+	with open(combined, 'rb') as f:
+		seconds, rss = run(['live.py', '--format', fmt, '--queries', queries, '--output', output, '--period', '3600', '--buffer', '1000'], stdin=f)
+	os.remove(combined)
+	return {'seconds': round(seconds, 3), 'requests_per_second': round(n_lines / seconds), 'peak_rss_bytes': rss}
+
+
+def bench_memory(fmt, index, work, memory_limits):
+	# peak RSS of historical.py running the example queries at each --memory
+	queries = os.path.join(work, 'historical-queries.sql')
+	with open(queries, 'w') as f:
+		f.write("\n##########\n".join(q + "\n" for q in example_queries.values()))
+	output = os.path.join(work, 'historical-output') + os.sep
+	os.makedirs(output, exist_ok=True)
+	results = []
+	for memory in memory_limits:
+		for name in os.listdir(output): os.remove(output + name)
+		seconds, rss = run(['historical.py', '--index', index, '--format', fmt, '--queries', queries, '--output', output, '--memory', str(memory)])
+		results.append({'memory': memory, 'seconds': round(seconds, 3), 'peak_rss_bytes': rss})
+	return results
+
+
+if __name__ == "__main__":
+	# default args:
+	formats = 'aws-elb-classic,aws-elb-application,ncsa-common,ncsa-combined'
+	lines = 200000
+	files = 4
+	buffer_size = 10000
+	memory = '10000000,100000000'
+	output = ''
+	work = ''
+
+	# parse cli args:
+	argv = sys.argv[1:]
+	try:
+		opts, args = getopt.getopt(argv, "", ["formats=", "lines=", "files=", "buffer=", "memory=", "output=", "work="])
+	except:
+		print("Error")
+		exit()
+	for opt, arg in opts:
+		if opt in ['--formats']:
+			formats = arg
+		elif opt in ['--lines']:
+			lines = arg
+		elif opt in ['--files']:
+			files = arg
+		elif opt in ['--buffer']:
+			buffer_size = arg
+		elif opt in ['--memory']:
+			memory = arg
+		elif opt in ['--output']:
+			output = arg
+		elif opt in ['--work']:
+			work = arg
+
+	# validate args:
+	formats = formats.split(',')
+	for fmt in formats:
+		if fmt!='aws-elb-classic' and fmt!='aws-elb-application' and fmt!='ncsa-common' and fmt!='ncsa-combined':
+			print('Argument "formats" must be a comma-separated list of "aws-elb-classic", "aws-elb-application", "ncsa-common", and "ncsa-combined".')
+			exit()
+	try:
+		lines, files, buffer_size = int(lines), int(files), int(buffer_size)
+		memory = [int(m) for m in memory.split(',')]
+	except:
+		print('Arguments "lines", "files" and "buffer" must be integers, and "memory" a comma-separated list of integers.')
+		exit()
+	if lines<files or files<=0 or buffer_size<=0 or min(memory)<=0:
+		print('Arguments "lines", "files", "buffer" and "memory" must be positive (and "lines" at least "files").')
+		exit()
+	if work!='' and not os.path.isdir(work):
+		print('Argument "work" must be a directory for the generated logs (by default, a temporary directory is used).')
+		exit()
+
+	temporary = work==''
+	if temporary: work = tempfile.mkdtemp(prefix='logservatory-benchmark-')
+	results = {
+		'started': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+		'python': platform.python_version(),
+		'sqlite': sqlite3.sqlite_version,
+		'platform': platform.platform(),
+		'cpus': os.cpu_count(),
+		'lines': lines,
+		'files': files,
+		'buffer': buffer_size,
+		'formats': {},
+	}
+	try:
+		git = subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=here, capture_output=True, text=True)
+		if git.returncode==0: results['version'] = git.stdout.strip()
+	except OSError:
+		pass
+
+	try:
+		for fmt in formats:
+			logs = os.path.join(work, fmt)
+			os.makedirs(logs, exist_ok=True)
+			if len(os.listdir(logs))==0:
+				run(['generate-logs.py', '--format', fmt, '--output', logs, '--files', str(files), '--lines', str(lines // files)])
+			n_lines = (lines // files) * files
+			r = {}
+			index, r['build_index'] = bench_index(fmt, logs, work, n_lines)
+			r['ingest'] = bench_ingest(fmt, logs, buffer_size)
+			r['query_seconds'] = bench_queries(work)
+			r['live'] = bench_live(fmt, logs, work, n_lines)
+			r['historical_memory'] = bench_memory(fmt, index, work, memory)
+			results['formats'][fmt] = r
+			print(fmt + ' done.', file=sys.stderr)
+	finally:
+		if temporary: shutil.rmtree(work)
+
+	if output!='':
+		with open(output, 'w') as f:
+			json.dump(results, f, indent=2)
+	else:
+		print(json.dumps(results, indent=2))
@@ -1,8 +1,13 @@
-import os, re, sys, getopt, time
-from dateutil import parser
+import os, sys, getopt, csv, sqlite3, multiprocessing
+import logservatory
 #from csv import writer
 #import pandas as pd
 
+parse_line = None
+timestamp_index = 0
+encoding = 'utf-8'
+checkpoint_lines = 0 # (with --db) record the byte offset and timestamp of every this many lines
+
 
 def tail(fName, lines=20):
 	total_lines_wanted = lines
@@ -28,10 +33,11 @@ def tail(fName, lines=20):
 	return all_read_text.splitlines()[-total_lines_wanted:]
 
 
-def rawcount(filename):
+def rawcount(filename, offset=0):
 	with open(filename, 'rb') as f:
 		lines = 0
 		buf_size = 1024 * 1024
+		if offset>0: f.seek(offset)
 		read_f = f.raw.read
 		buf = read_f(buf_size)
 		while buf:
@@ -40,54 +46,220 @@ def rawcount(filename):
 	return lines
 
 
-def process_logs(path, regex, fields):
-	results = []
+def checkpoint_offsets(filename, offset=0, first_line=0):
+	# like rawcount(), but also returns the byte offsets at which lines number k*checkpoint_lines start
+	offsets = []
+	with open(filename, 'rb') as f:
+		lines = first_line
+		next_line = max(checkpoint_lines, -(-first_line // checkpoint_lines) * checkpoint_lines)
+		if next_line==first_line:
+			offsets.append(offset) # (appended lines starting right at a checkpoint)
+			next_line += checkpoint_lines
+		buf_size = 1024 * 1024
+		if offset>0: f.seek(offset)
+		read_f = f.raw.read
+		buf = read_f(buf_size)
+		while buf:
+			n = buf.count(b'\n')
+			i = -1
+			while lines + n>=next_line:
+				for k in range(next_line - lines):
+					i = buf.find(b'\n', i + 1)
+				n -= next_line - lines
+				lines = next_line
+				offsets.append(offset + i + 1)
+				next_line += checkpoint_lines
+			lines += n
+			offset += len(buf)
+			buf = read_f(buf_size)
+	return lines - first_line, offsets
+
+
+def checkpoints(fName, offsets):
+	# (offset, timestamp) of the first line that parses at or after each offset
+	result = []
+	with open(fName, 'rb') as f:
+		for offset in offsets:
+			f.seek(offset)
+			for k in range(10):
+				line = f.readline()
+				if not line: break
+				row = parse_line(line.decode(encoding, 'replace'))
+				if row is not None:
+					result.append((offset, row[timestamp_index]))
+					break
+				offset += len(line)
+	return result
+
+
+def scan_compressed(fName, lines=20):
+	# one streaming pass over a compressed file (it can't be seeked from the end):
+	# returns the line count, uncompressed size, and the first and last lines
+	n = 0
+	size = 0
+	head = b''
+	last = b''
+	with logservatory.open_log(fName, text=False) as f:
+		buf = f.read(logservatory.read_block_size)
+		while buf:
+			if size==0: head = buf
+			n += buf.count(b'\n')
+			size += len(buf)
+			last = (last + buf)[-64 * 1024:]
+			buf = f.read(logservatory.read_block_size)
+	return n, size, head.splitlines()[:lines], last.splitlines()[-lines:]
+
+
+def init_worker(fmt, enc, every=0):
+	# (runs in each indexing process)
+	global parse_line, timestamp_index, encoding, checkpoint_lines
+	parse_line = logservatory.make_parser(fmt)
+	timestamp_index = logservatory.get_timestamp_index(fmt)
+	encoding = enc
+	checkpoint_lines = every
+
+
+def timestamps(lines):
+	ts = []
+	for l in lines:
+		row = parse_line(l)
+		if row is not None: ts.append(row[timestamp_index])
+	return ts
+
+
+def index_file(task):
+	# returns the index row and checkpoints for one file, or None if none of its head/tail lines parse
+	fName, fSize, fMtime, fInode, old = task
 	nLines = 10
-	for fName in os.listdir(path):
-		if os.path.isdir(path+fName): # recurse into subdir
-			subresults = process_logs(path+fName+'/', regex, fields)
-			for r in subresults:
-				results.append(r)
+	if logservatory.compression(fName) is not None:
+		# (compressed files can't be seeked into, so they get no checkpoints)
+		fLines, fUncompressed, head, last = scan_compressed(fName, nLines)
+		lines = [l.decode(encoding, 'replace') for l in last[1:] + head]
+		ts = timestamps(lines)
+		if len(ts)==0:
+			return None
+		return [fName, str(fSize), str(fLines), str(min(ts)), str(max(ts)), str(fMtime), str(fInode), str(fUncompressed)], []
+	lines = [l.decode(encoding, 'replace') for l in tail(fName, nLines)]
+	if len(lines)>0:
+		del lines[0]
+	offsets = []
+	if old is not None and old.get('inode')==str(fInode) and int(old['size_bytes'])<fSize:
+		# appended to since the last index: only count the new tail
+		if checkpoint_lines>0:
+			fLines, offsets = checkpoint_offsets(fName, int(old['size_bytes']), int(old['n_lines']))
+			fLines += int(old['n_lines'])
+		else:
+			fLines = int(old['n_lines']) + rawcount(fName, int(old['size_bytes']))
+		ts = timestamps(lines) + [int(old['min_ts']), int(old['max_ts'])]
+		old_checkpoints = old.get('checkpoints', [])
+	else:
+		if checkpoint_lines>0:
+			fLines, offsets = checkpoint_offsets(fName)
 		else:
-			# for each file, count lines, get file size
-			fSize = os.path.getsize(path+fName)
-			fLines = rawcount(path+fName)
-			lines = [l.decode() for l in tail(path+fName, nLines)]
-			if len(lines)>0:
-				del lines[0]
-			with open(path+fName) as f:
-				lines.extend(f.readline() for i in range(nLines))
-			# get min/max timestamp from firstNlines and lastNlines
-			fMinTs = 99999999999999999
-			fMaxTs = 0
-			has_matches = False
-			for l in lines:
-				matches = re.search(regex, l.strip())
-				if matches:
-					has_matches = True
-					values = []
-					for i, field in enumerate(fields):
-						values.append(matches.group(i+1))
-					ts = values[fields.index('timestamp')]
-					ts = int(parser.parse(ts).strftime('%s'))
-					if ts>fMaxTs:
-						fMaxTs = ts
-					elif ts<fMinTs:
-						fMinTs = ts
-			if has_matches:
-				results.append([path+fName, str(fSize), str(fLines), str(fMinTs), str(fMaxTs)])
-	return results
+			fLines = rawcount(fName)
+		with open(fName, encoding=encoding, errors='replace') as f:
+			lines.extend(f.readline() for i in range(nLines))
+		ts = timestamps(lines)
+		old_checkpoints = []
+	# get min/max timestamp from firstNlines and lastNlines
+	if len(ts)==0:
+		return None
+	return [fName, str(fSize), str(fLines), str(min(ts)), str(max(ts)), str(fMtime), str(fInode), str(fSize)], old_checkpoints + checkpoints(fName, offsets)
+
+
+def list_files(path, old_index):
+	# yields one task per file, in the same order as before; unchanged files (same size and mtime
+	# as in old_index) are passed through without being read
+	for root, dirs, files in os.walk(path):
+		dirs.sort()
+		for name in sorted(files):
+			fName = os.path.join(root, name)
+			st = os.stat(fName)
+			old = old_index.get(fName)
+			if old is not None and old.get('mtime')==str(st.st_mtime_ns) and old['size_bytes']==str(st.st_size):
+				yield [[fName, old['size_bytes'], old['n_lines'], old['min_ts'], old['max_ts'], old['mtime'], old['inode'],
+					old.get('uncompressed_bytes') or old['size_bytes']], old.get('checkpoints', [])]
+			else:
+				yield (fName, st.st_size, st.st_mtime_ns, st.st_ino, old)
+
+
+def index_or_reuse(task):
+	if isinstance(task, tuple): return index_file(task)
+	return task
+
+
+def process_logs(path, fmt, old_index={}, workers=1, every=0):
+	# yields (index row, checkpoints) for all files under path, in order; with workers>1 files are indexed by a process pool
+	tasks = list_files(path, old_index)
+	if workers<=1:
+		init_worker(fmt, encoding, every)
+		for r in map(index_or_reuse, tasks):
+			if r is not None: yield r
+		return
+	with multiprocessing.Pool(workers, init_worker, (fmt, encoding, every)) as pool:
+		for r in pool.imap(index_or_reuse, tasks, chunksize=16):
+			if r is not None: yield r
+
+
+def load_old_index(path):
+	old_index = {}
+	if logservatory.is_sqlite(path):
+		conn = sqlite3.connect(path)
+		conn.row_factory = sqlite3.Row
+		ids = {}
+		for row in conn.execute("SELECT * FROM logs_idx"):
+			old = dict((k, str(row[k])) for k in row.keys())
+			old['checkpoints'] = []
+			old_index[old['file']] = old
+			ids[row['id']] = old
+		for file_id, offset, ts in conn.execute("SELECT file_id, offset, ts FROM checkpoints ORDER BY file_id, offset"):
+			ids[file_id]['checkpoints'].append((offset, ts))
+		conn.close()
+		return old_index
+	with open(path, 'r') as fin:
+		for row in csv.DictReader(fin):
+			old_index[row['file']] = row
+	return old_index
+
+
+def write_db(path, results):
+	# writes a SQLite index: the same columns as the CSV index (plus an id), an r-tree over
+	# [min_ts, max_ts] for time range lookups, and the checkpoints of each file
+	if os.path.exists(path + '.tmp'): os.remove(path + '.tmp')
+	conn = sqlite3.connect(path + '.tmp')
+	cur = conn.cursor()
+	cur.execute("""CREATE TABLE logs_idx (id integer primary key, file string, size_bytes bigint, n_lines bigint,
+			min_ts bigint, max_ts bigint, mtime string, inode string, uncompressed_bytes bigint)""")
+	cur.execute("CREATE TABLE checkpoints (file_id integer, offset bigint, ts bigint, PRIMARY KEY (file_id, offset)) WITHOUT ROWID")
+	try:
+		cur.execute("CREATE VIRTUAL TABLE logs_idx_range USING rtree(id, min_ts, max_ts)")
+		rtree = True
+	except sqlite3.OperationalError:
+		# (SQLite built without the r-tree module) a plain view, so lookups scan the index instead
+		cur.execute("CREATE VIEW logs_idx_range AS SELECT id, min_ts, max_ts FROM logs_idx")
+		rtree = False
+	for id, (r, cps) in enumerate(results, 1):
+		cur.execute("INSERT INTO logs_idx VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", [id] + r)
+		if rtree: cur.execute("INSERT INTO logs_idx_range VALUES (?, ?, ?)", (id, int(r[3]), int(r[4])))
+		cur.executemany("INSERT INTO checkpoints VALUES (?, ?, ?)", [(id, offset, ts) for offset, ts in cps])
+	conn.commit()
+	conn.close()
+	os.replace(path + '.tmp', path)
 
 
 if __name__ == "__main__":
 	# default args:
 	input = ''
 	format = 'aws-eb-classic'
+	update = ''
+	workers = 1
+	db = ''
+	every = 10000
 
 	# parse cli args:
 	argv = sys.argv[1:]
 	try: 
-		opts, args = getopt.getopt(argv, "", ["input=", "format=", "encoding="]) 
+		opts, args = getopt.getopt(argv, "", ["input=", "format=", "encoding=", "update=", "workers=", "db=", "checkpoint-lines="]) 
 	except: 
 		print("Error")
 		exit()
@@ -96,6 +268,16 @@ if __name__ == "__main__":
 			input = arg
 		elif opt in ['--format']:
 			format = arg
+		elif opt in ['--encoding']:
+			encoding = arg
+		elif opt in ['--update']:
+			update = arg
+		elif opt in ['--workers']:
+			workers = arg
+		elif opt in ['--db']:
+			db = arg
+		elif opt in ['--checkpoint-lines']:
+			every = arg
 
 	# validate args:
 	if format!='aws-elb-classic' and format!='aws-elb-application' and format!='ncsa-common' and format!='ncsa-combined':
@@ -104,29 +286,34 @@ if __name__ == "__main__":
 	if not os.path.isdir(input):
 		print('Argument "input" must be a directory where log files are stored.')
 		exit()
+	if update!='' and not os.path.isfile(update):
+		print('Argument "update" must be an existing index file (created with build-index.py).')
+		exit()
+	try:
+		workers = int(workers)
+	except:
+		print('Argument "workers" (the number of indexing processes) must be an integer.')
+		exit()
+	if workers<=0:
+		print('Argument "workers" (the number of indexing processes) must be a positive integer.')
+		exit()
+	try:
+		every = int(every)
+	except:
+		print('Argument "checkpoint-lines" (how many lines apart checkpoints are) must be an integer.')
+		exit()
+	if every<0:
+		print('Argument "checkpoint-lines" (how many lines apart checkpoints are) must be a positive integer, or 0 for no checkpoints.')
+		exit()
 
-	if format=='aws-elb-classic':
-		fields = ["timestamp", "elb", "client_ip", "client_port", "backend_ip", "backend_port",
-			"request_processing_time", "backend_processing_time", "response_processing_time",
-			"elb_status_code", "backend_status_code", "received_bytes", "sent_bytes",
-			"request_verb", "request_url", "request_protocol", "user_agent",
-			"ssl_cipher", "ssl_protocol",
-		]
-		regex = r"([^ ]*) ([^ ]*) ([^ ]*):([0-9]*) ([^ ]*)[:-]([0-9]*) ([-.0-9]*) ([-.0-9]*) ([-.0-9]*) (|[-0-9]*) (-|[-0-9]*) ([-0-9]*) ([-0-9]*) \"([^ ]*) ([^ ]*) (- |[^ ]*)\" (\"[^\"]*\") ([A-Z0-9-]+) ([A-Za-z0-9.-]*)$"
-
-	if format=='aws-elb-application':
-		fields = ["type", "timestamp", "elb", "client_ip", "client_port", "backend_ip", "backend_port",
-			"request_processing_time", "backend_processing_time", "response_processing_time",
-			"elb_status_code", "backend_status_code", "received_bytes", "sent_bytes",
-			"request_verb", "request_url", "request_protocol", "user_agent",
-			"ssl_cipher", "ssl_protocol",
-		]
-		regex = r"([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*):([0-9]*) ([^ ]*)[:-]([0-9]*) ([-.0-9]*) ([-.0-9]*) ([-.0-9]*) (|[-0-9]*) (-|[-0-9]*) ([-0-9]*) ([-0-9]*) \"([^ ]*) ([^ ]*) (- |[^ ]*)\" \"([^\"]*)\" ([A-Z0-9-]+) ([A-Za-z0-9.-]*) ([^ ]*) \"([^\"]*)\" \"([^\"]*)\" \"([^\"]*)\" ([-.0-9]*) ([^ ]*) \"([^\"]*)\" \"([^\"]*)\" \"([^ ]*)\" \"([^\s]+?)\" \"([^\s]+)\" \"([^ ]*)\" \"([^ ]*)\""
-		#([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*):([0-9]*) ([^ ]*)[:-]([0-9]*) ([-.0-9]*) ([-.0-9]*) ([-.0-9]*) (|[-0-9]*) (-|[-0-9]*) ([-0-9]*) ([-0-9]*) \"([^ ]*) ([^ ]*) (- |[^ ]*)\" (\"[^\"]*\") ([A-Z0-9-]+) ([A-Za-z0-9.-]*)$"
-
+	old_index = {}
+	if update!='':
+		old_index = load_old_index(update)
 
 	# process logs:
-	results = process_logs(input, regex, fields)
-	print('file,size_bytes,n_lines,min_ts,max_ts')
-	for r in results:
+	if db!='':
+		write_db(db, process_logs(input, format, old_index, workers, every))
+		exit()
+	print('file,size_bytes,n_lines,min_ts,max_ts,mtime,inode,uncompressed_bytes')
+	for r, cps in process_logs(input, format, old_index, workers):
 		print(','.join(r))
@@ -0,0 +1,173 @@
+import os, sys, getopt, random, time, gzip, bz2
+from datetime import datetime
+from dateutil.parser import parse
+
+# Writes synthetic access logs in any of Logservatory's formats, for testing and benchmarks (see benchmark.py).
+# Clients, URLs and user agents are drawn from pools of configurable size with Zipf-like popularity,
+# so the output has the skew of real traffic.
+
+verbs = ['GET'] * 90 + ['POST'] * 7 + ['PUT', 'DELETE', 'HEAD']
+statuses = [200] * 80 + [304] * 6 + [301] * 4 + [404] * 6 + [403, 500, 502, 503]
+paths = ['/', '/index.html', '/search?q={word}', '/products/{n}', '/products/{n}/reviews', '/api/v1/items?page={n}',
+	'/static/{word}.css', '/static/{word}.js', '/img/{word}.png', '/blog/{year}/{word}.html', '/login', '/cart']
+words = ['foo', 'bar', 'baz', 'shoes', 'hats', 'socks', 'winter', 'summer', 'sale', 'new', 'gift', 'red', 'blue', 'green']
+agents = ['Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+	'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.1.1 Safari/605.1.15',
+	'Mozilla/5.0 (X11; Linux x86_64; rv:89.0) Gecko/20100101 Firefox/89.0',
+	'Mozilla/5.0 (iPhone; CPU iPhone OS 14_6 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.1.1 Mobile/15E148 Safari/604.1',
+	'Googlebot/2.1 (+http://www.google.com/bot.html)', 'curl/7.68.0', 'python-requests/2.25.1']
+ciphers = ['ECDHE-RSA-AES128-GCM-SHA256', 'ECDHE-RSA-AES256-GCM-SHA384', '-']
+
+
+def pool(n, make):
+	# n distinct values, and Zipf weights for picking them
+	values = [make(i) for i in range(n)]
+	weights = [1.0 / (i + 1) for i in range(n)]
+	return values, weights
+
+
+def make_url(i):
+	path = paths[i % len(paths)]
+	return path.format(word=words[(i // len(paths)) % len(words)] + (str(i // (len(paths) * len(words))) if i>=len(paths) * len(words) else ''),
+		n=i, year=2015 + i % 7)
+
+
+def make_ip(i):
+	return '%d.%d.%d.%d' % (random.randint(1, 223), random.randint(0, 255), random.randint(0, 255), random.randint(1, 254))
+
+
+def make_agent(i):
+	if i<len(agents): return agents[i]
+	return agents[i % len(agents)].replace('537.36', '537.' + str(i))
+
+
+def format_line(fmt, ts, ip, url, agent, rng):
+	status = rng.choice(statuses)
+	sent = int(rng.lognormvariate(8, 1.5)) if status!=304 else 0
+	verb = rng.choice(verbs)
+	if fmt=='ncsa-common' or fmt=='ncsa-combined':
+		line = '%s - %s [%s +0000] "%s %s HTTP/1.1" %d %d' % (ip, rng.choice(['-'] * 9 + ['frank']),
+			time.strftime('%d/%b/%Y:%H:%M:%S', time.gmtime(ts)), verb, url, status, sent)
+		if fmt=='ncsa-combined':
+			line += ' "%s" "%s"' % (rng.choice(['-', 'https://www.google.com/', 'https://ex.com/']), agent)
+		return line
+	t = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(ts)) + '.%06dZ' % int((ts % 1) * 1000000)
+	backend_status = '-' if status in [502, 503] else str(status)
+	backend = '-' if backend_status=='-' else '10.0.%d.%d:80' % (rng.randint(0, 3), rng.randint(1, 20))
+	proc = '-1' if backend=='-' else '%.6f' % rng.expovariate(20)
+	cipher = rng.choice(ciphers)
+	protocol = '-' if cipher=='-' else 'TLSv1.2'
+	scheme = 'http' if cipher=='-' else 'https'
+	port = 80 if cipher=='-' else 443
+	request = '%s %s://www.ex.com:%d%s HTTP/1.1' % (verb, scheme, port, url)
+	if fmt=='aws-elb-classic':
+		return '%s my-lb %s:%d %s 0.000041 %s 0.000025 %d %s %d %d "%s" "%s" %s %s' % (t, ip, rng.randint(1024, 65535), backend,
+			proc, status, backend_status, rng.choice([0] * 9 + [rng.randint(100, 5000)]), sent, request, agent, cipher, protocol)
+	return ('%s %s app/my-lb/50dc6c495c0c9188 %s:%d %s 0.000041 %s 0.000025 %d %s %d %d "%s" "%s" %s %s '
+		'arn:aws:elasticloadbalancing:us-east-2:123456789012:targetgroup/my-targets/73e2d6bc24d8a067 '
+		'"Root=1-58337262-36d228ad5d99923122bbe354" "www.ex.com" "-" 0 %s "forward" "-" "-" "%s" "%s" "-" "-"') % (
+		'https' if cipher!='-' else 'http', t, ip, rng.randint(1024, 65535), backend, proc, status, backend_status,
+		rng.choice([0] * 9 + [rng.randint(100, 5000)]), sent, request, agent, cipher, protocol, t,
+		backend if backend!='-' else '-', backend_status)
+
+
+def generate(fmt, out, n_lines, start_ts, rate, ip_pool, url_pool, agent_pool, rng):
+	# writes n_lines lines starting at start_ts, at ~rate lines per second (with ELB-style jitter,
+	# so a few lines are slightly out of order); returns the timestamp after the last line
+	jitter = fmt[:3]=='aws'
+	ts = start_ts + (0.5 if jitter else 0)
+	for i in range(n_lines):
+		ts += rng.expovariate(rate)
+		line_ts = ts - rng.random() * 0.5 if jitter else ts
+		out.write(format_line(fmt, line_ts, rng.choices(ip_pool[0], ip_pool[1])[0], rng.choices(url_pool[0], url_pool[1])[0],
+			rng.choices(agent_pool[0], agent_pool[1])[0], rng) + '\n')
+	return ts
+
+
+if __name__ == "__main__":
+	# default args:
+	format = 'aws-elb-classic'
+	output = ''
+	files = 1
+	lines = 100000
+	rate = 100
+	start = '2020-09-13T00:00:00+00:00'
+	ips = 10000
+	urls = 2000
+	user_agents = 50
+	seed = 1
+	compress = ''
+
+	# parse cli args:
+	argv = sys.argv[1:]
+	try:
+		opts, args = getopt.getopt(argv, "", ["format=", "output=", "files=", "lines=", "rate=", "start=", "ips=", "urls=", "user-agents=", "seed=", "compress="])
+	except:
+		print("Error")
+		exit()
+	for opt, arg in opts:
+		if opt in ['--format']:
+			format = arg
+		elif opt in ['--output']:
+			output = arg
+		elif opt in ['--files']:
+			files = arg
+		elif opt in ['--lines']:
+			lines = arg
+		elif opt in ['--rate']:
+			rate = arg
+		elif opt in ['--start']:
+			start = arg
+		elif opt in ['--ips']:
+			ips = arg
+		elif opt in ['--urls']:
+			urls = arg
+		elif opt in ['--user-agents']:
+			user_agents = arg
+		elif opt in ['--seed']:
+			seed = arg
+		elif opt in ['--compress']:
+			compress = arg
+
+	# validate args:
+	if format!='aws-elb-classic' and format!='aws-elb-application' and format!='ncsa-common' and format!='ncsa-combined':
+		print('Argument "format" (the log format) must be one of "aws-elb-classic", "aws-elb-application", "ncsa-common", or "ncsa-combined".')
+		exit()
+	if output!='' and not os.path.isdir(output):
+		print('Argument "output" must be a directory to write log files to. Leave it out to write to standard output.')
+		exit()
+	try:
+		files, lines, ips, urls, user_agents, seed = int(files), int(lines), int(ips), int(urls), int(user_agents), int(seed)
+		rate = float(rate)
+	except:
+		print('Arguments "files", "lines", "ips", "urls", "user-agents" and "seed" must be integers, and "rate" a number.')
+		exit()
+	if files<=0 or lines<=0 or ips<=0 or urls<=0 or user_agents<=0 or rate<=0:
+		print('Arguments "files", "lines", "rate", "ips", "urls" and "user-agents" must be positive.')
+		exit()
+	try:
+		start = datetime.timestamp(parse(start))
+	except:
+		print('Argument "start" (the first timestamp) could not be parsed.')
+		exit()
+	if compress!='' and compress!='gzip' and compress!='bz2':
+		print('Argument "compress" must be "gzip" or "bz2". Leave it out to write uncompressed files.')
+		exit()
+
+	rng = random.Random(seed)
+	random.seed(seed)
+	ip_pool = pool(ips, make_ip)
+	url_pool = pool(urls, make_url)
+	agent_pool = pool(user_agents, make_agent)
+
+	if output=='':
+		for n in range(files):
+			start = generate(format, sys.stdout, lines, start, rate, ip_pool, url_pool, agent_pool, rng)
+		exit()
+	for n in range(files):
+		name = os.path.join(output, format + '-' + str(n).zfill(5) + '.log')
+		if compress=='gzip': f = gzip.open(name + '.gz', 'wt')
+		elif compress=='bz2': f = bz2.open(name + '.bz2', 'wt')
+		else: f = open(name, 'w')
+		with f:
+			start = generate(format, f, lines, start, rate, ip_pool, url_pool, agent_pool, rng)
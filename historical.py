@@ -1,5 +1,4 @@
-import os, re, sys, getopt, time
-import sys, time
+import os, time
 import logservatory
 
 
@@ -8,8 +7,9 @@ if __name__ == "__main__":
 	logservatory.parse_args('static')
 	logservatory.validate_args('static')
 	logservatory.start_database()
+	if logservatory.resume: logservatory.restore_checkpoint('static')
+	if logservatory.merge: logservatory.start_staging()
 	start_timestamp = int(time.time())
-	page_size = logservatory.get_db_stat('PRAGMA page_size')
 
 	# start processing logs from index:
 	logservatory.load_index()
@@ -20,42 +20,38 @@ if __name__ == "__main__":
 	#else: global_end = logservatory.get_db_stat('SELECT MAX(max_ts) FROM logs_idx')
 
 	logs_idx_rows = logservatory.fetch_log_files()
-	# log rows contain columns: 0=file, 1=size_bytes, 2=n_lines, 3=min_ts, 4=max_ts
-
-	buffer_size = 0
-	n_logs = 0
-	n_requests = 0
-	n_bytes = 0
-	for log_idx_row in logs_idx_rows:
-		with open(log_idx_row[0], 'r', encoding=logservatory.encoding) as file:
-			for line in file: logservatory.buffer.append(line.strip())
-		buffer_size += int(log_idx_row[1])
-		n_logs += 1
-		n_requests += int(log_idx_row[2])
-		n_bytes = int(log_idx_row[1])
-
-		if len(logservatory.buffer)>= 100000: # hard-code buffer_size of 100k lines
-			logservatory.ingest_logs()
-			logservatory.buffer = []
-			buffer_size = 0
+	# log rows contain columns: 0=file, 1=size_bytes, 2=n_lines, 3=min_ts, 4=max_ts, 5=uncompressed_bytes, 6=id, 7=sample weight
+
+	# files are read in chunks of ~buffer lines, parsed (by --workers processes), and inserted here in index order
+	n_logs = len(logs_idx_rows)
+	n_requests = sum([int(log_idx_row[2]) for log_idx_row in logs_idx_rows])
+	n_bytes = sum([int(log_idx_row[5]) for log_idx_row in logs_idx_rows])
+	for file_number, offset, rows in logservatory.parse_log_chunks(logs_idx_rows):
+		logservatory.insert_rows(rows, logs_idx_rows[file_number][7])
+
+		# once the database plus the lines still being read and parsed near the memory limit,
+		# run the queries and empty the logs table to make room for new data
+		# (with --window, the trailing partial window is kept for the next batch)
+		if logservatory.memory_estimate() >= 0.9 * logservatory.memory:
+			held_rows = logservatory.hold_partial_window()
+			logservatory.build_indexes()
 			logservatory.print_db_stats()
-
-			# empty logs table to make room for new data
-			page_count = logservatory.get_db_stat('PRAGMA page_count')
-			database_size = page_size * page_count
-			if database_size >= 0.9 * logservatory.memory:
-				logservatory.run_queries(mode='static')
-				cur = logservatory.connection.cursor()
-				cur.execute("DELETE FROM logs")
-				logservatory.connection.commit()
-				logservatory.get_db_stat("vacuum")
+			logservatory.run_queries(mode='static')
+			logservatory.write_metrics({'files_started': file_number + 1, 'files': n_logs})
+			logservatory.clear_logs()
+			logservatory.insert_rows(held_rows, None)
+			# everything up to here is in the outputs (or held in the database): carry on from here after a crash
+			logservatory.save_checkpoint('static', {'position': [file_number, logs_idx_rows[file_number][0], offset],
+				'files': [[row[0], row[7]] for row in logs_idx_rows] if logservatory.sample<1.0 and logservatory.sample_mode!='lines' else None})
 
 	# process final queries after logs are done ingesting
-	logservatory.ingest_logs()
-	logservatory.buffer = []
-	buffer_size = 0
+	logservatory.build_indexes()
 	logservatory.print_db_stats()
 	logservatory.run_queries(mode='static')
+	logservatory.close_outputs()
+	if logservatory.merge: logservatory.merge_results()
+	logservatory.write_metrics({'files_started': n_logs, 'files': n_logs})
+	if logservatory.checkpoint_file!='' and os.path.exists(logservatory.checkpoint_file): os.remove(logservatory.checkpoint_file)
 
 	end_timestamp = int(time.time())
 	print("Done. Processed "+str(n_logs)+" log files, "+str(n_requests)+" requests, "+str(n_bytes)+" bytes of data in "+str(end_timestamp-start_timestamp)+" seconds.")
@@ -1,42 +1,242 @@
-import sys, time
+import os, sys, time, glob, stat, queue, signal, sqlite3, threading
 import logservatory
 
+n_read = 0 # lines read from stdin
+n_dropped = 0 # lines discarded because the queue was full (with --overflow drop)
+n_skipped = 0 # query runs skipped because the previous run took longer than period
+last_run_seconds = 0.0
+follow_interval = 1.0 # seconds between looks for new data in the followed files (with --follow)
+offsets = {} # (device, inode) -> [path, offset] up to which each followed file is buffered
+ingested_offsets = {} # the same, up to what's ingested (saved with checkpoints)
+stopping = threading.Event() # set on SIGTERM/SIGINT: finish what's read, save a checkpoint and exit
+
+
+def read_input(lines):
+	# (reader thread) keep reading stdin into the queue, whatever the ingester and queries are doing
+	global n_read, n_dropped
+	for line in sys.stdin:
+		if line=='\x04\n' or stopping.is_set(): break
+		n_read += 1
+		if logservatory.overflow=='drop':
+			try:
+				lines.put_nowait(line)
+			except queue.Full:
+				n_dropped += 1
+		else:
+			lines.put(line) # blocks when full, which slows down the producer
+	if not stopping.is_set(): lines.put(None) # (when stopping, the ingester isn't waiting for it)
+
+
+def follow_files(lines, saved):
+	# (reader thread, with --follow) tail the files matching the follow patterns into the queue, a block at
+	# a time. Files are told apart by inode, so a rotated (renamed) file is read to its end before it's let
+	# go, and a truncated one is read again from the start. Files that appear later are read from the
+	# start; files there at startup from their end, or from their saved offset when resuming.
+	# After each block, a (path, file, offset) marker follows its lines through the queue. When stopping,
+	# it ends the input after the last whole block, so the saved offsets cover exactly what's ingested.
+	global n_read
+	saved = dict(((dev, inode), offset) for path, dev, inode, offset in saved)
+	followed = {} # (device, inode) -> [path, offset, open file]
+	skipped = set() # compressed files (already rotated and compressed)
+	block = logservatory.read_block_size
+	first_scan = True
+	while not stopping.is_set():
+		found = {}
+		for pattern in logservatory.follow:
+			for path in glob.glob(pattern):
+				try:
+					st = os.stat(path)
+				except OSError:
+					continue
+				if stat.S_ISREG(st.st_mode): found[(st.st_dev, st.st_ino)] = (path, st.st_size)
+		for key, (path, size) in found.items():
+			if key in followed:
+				followed[key][0] = path
+				if size<followed[key][1]: followed[key][1] = 0 # (truncated, like logrotate's copytruncate)
+				continue
+			if key in skipped: continue
+			try:
+				if logservatory.compression(path) is not None:
+					skipped.add(key)
+					continue
+				f = open(path, 'rb')
+			except OSError:
+				continue
+			if key in saved: offset = saved[key] if saved[key]<=size else 0
+			elif first_scan and not logservatory.resume: offset = size
+			else: offset = 0
+			followed[key] = [path, offset, f]
+		first_scan = False
+
+		busy = False
+		for key in list(followed):
+			if stopping.is_set(): break
+			path, offset, f = followed[key]
+			f.seek(offset)
+			data = f.read(block)
+			end = data.rfind(b'\n') + 1 # (only whole lines; the rest is read again next time)
+			if end==0 and len(data)==block: end = block # (a line longer than a block)
+			if end>0:
+				chunks = data[:end].split(b'\n')
+				if chunks[-1]==b'': chunks.pop()
+				for chunk in chunks:
+					n_read += 1
+					lines.put(chunk.decode(logservatory.encoding, errors='replace') + '\n')
+				followed[key][1] = offset + end
+				lines.put((path, key, offset + end))
+				busy = busy or len(data)==block
+			elif key not in found:
+				# rotated away (or deleted) and read to the end
+				f.close()
+				del followed[key]
+				lines.put((path, key, None))
+		if not busy: stopping.wait(follow_interval)
+	lines.put(None)
+
+
+def follow_state():
+	# (under db_lock) the followed files' offsets up to what's ingested, saved with checkpoints
+	return [[path, key[0], key[1], offset] for key, (path, offset) in ingested_offsets.items()]
+
+
+def run_period(final=False):
+	# snapshot the database (briefly holding the lock) and run the queries over the snapshot,
+	# so ingestion carries on while they run
+	global last_run_seconds
+	run_start = time.monotonic()
+	checkpoint = logservatory.checkpoint_file!='' and (final or time.monotonic() - logservatory.last_checkpoint >= logservatory.checkpoint_period)
+	if hasattr(logservatory.connection, 'serialize'):
+		with logservatory.db_lock:
+			logservatory.build_indexes()
+			if logservatory.query_workers<=1: data = logservatory.snapshot_connection()
+			else: data = logservatory.connection.serialize()
+			logservatory.mark_changes(final)
+			# (the checkpoint is the snapshot, with the offsets and state that go with it, written after the queries)
+			if checkpoint: state = dict(logservatory.database_state(), follow=follow_state())
+		logservatory.run_queries(mode='live', data=data)
+		last_run_seconds = time.monotonic() - run_start
+		if checkpoint: logservatory.save_checkpoint('live', state, data)
+		if isinstance(data, sqlite3.Connection): data.close()
+		data = None
+	else:
+		with logservatory.db_lock:
+			logservatory.build_indexes()
+			logservatory.mark_changes(final)
+			logservatory.run_queries(mode='live')
+			last_run_seconds = time.monotonic() - run_start
+			if checkpoint: logservatory.save_checkpoint('live', {'follow': follow_state()})
+	with logservatory.db_lock:
+		logservatory.print_db_stats()
+		logservatory.write_metrics({'queue_lines': lines.qsize(), 'lines_read': n_read, 'lines_dropped': n_dropped,
+			'runs_skipped': n_skipped, 'last_run_seconds': round(last_run_seconds, 3)})
+	print("Queue "+str(lines.qsize())+"/"+str(logservatory.queue_size)+" lines, "+str(n_read)+" read, "+str(n_dropped)+" dropped, "
+		+str(logservatory.n_late)+" late, "+str(logservatory.metrics['partitions_evicted'])+" partitions evicted, "+str(logservatory.metrics['partitions_coalesced'])+" coalesced. "
+		+"Queries took "+str(round(last_run_seconds, 3))+"s ("+str(n_skipped)+" runs skipped).")
+
+
+def stop_input(signum, frame):
+	# (SIGTERM/SIGINT) stop reading, and let the main loop ingest what's read, run the queries and save a
+	# final checkpoint; a second signal exits right away
+	stopping.set()
+	signal.signal(signum, signal.SIG_DFL)
+
+
+def schedule_queries(stop):
+	# (scheduler thread) run the queries every period wall-clock seconds, even if no input arrives
+	global n_skipped
+	next_run = time.monotonic() + logservatory.period
+	while not stop.wait(max(0, next_run - time.monotonic())):
+		try:
+			run_period()
+		except Exception as e:
+			# (like a full disk for the metrics or checkpoint) report it, and try again next period
+			print('Query run failed: '+str(e))
+			with logservatory.metrics_lock:
+				logservatory.metrics['query_errors'] += 1
+		next_run += logservatory.period
+		now = time.monotonic()
+		if next_run < now: # the run took longer than period: skip the runs we missed
+			missed = int((now - next_run) // logservatory.period) + 1
+			n_skipped += missed
+			next_run += missed * logservatory.period
+
 
 if __name__ == "__main__":
 
 	logservatory.parse_args('live')
 	logservatory.validate_args('live')
 	logservatory.start_database()
+	state = {}
+	if logservatory.resume: state = logservatory.restore_checkpoint('live')
 	page_size = logservatory.get_db_stat('PRAGMA page_size')
+	copies = logservatory.snapshot_copies()
 
 	# start processing logs:
-	last_run_timestamp = 0
-	for line in sys.stdin:
-		if line=='\x04\n': break
+	lines = queue.Queue(logservatory.queue_size)
+	stop = threading.Event()
+	if len(logservatory.follow)>0:
+		reader = threading.Thread(target=follow_files, args=(lines, state.get('follow', [])), daemon=True)
+	else:
+		reader = threading.Thread(target=read_input, args=(lines,), daemon=True)
+	scheduler = threading.Thread(target=schedule_queries, args=(stop,), daemon=True)
+	signal.signal(signal.SIGTERM, stop_input)
+	signal.signal(signal.SIGINT, stop_input)
+	reader.start()
+	scheduler.start()
 
-		# add line to a buffer
-		logservatory.buffer.append(line)
+	while True:
+		# (stdin can't be stopped at a known offset, so it stops right away: the buffer is ingested below,
+		# what's still queued is dropped. With --follow, the reader ends the input after its last whole block.)
+		if stopping.is_set() and len(logservatory.follow)==0: break
+		# wait for a line, but ingest what's buffered if the input goes quiet for a second
+		try:
+			line = lines.get(timeout=1)
+		except queue.Empty:
+			line = ''
+		if line is None: break
+		if isinstance(line, tuple):
+			# (with --follow) the lines before this are from path, up to offset
+			path, key, offset = line
+			if offset is None: offsets.pop(key, None)
+			else: offsets[key] = [path, offset]
+			if len(logservatory.buffer)==0:
+				with logservatory.db_lock:
+					ingested_offsets = dict(offsets) # (its lines are all ingested already)
+			continue
 
-		# every buffer_size lines, process buffer
-		if len(logservatory.buffer) >= logservatory.buffer_size:
-			logservatory.ingest_logs()
-			logservatory.buffer = [] # empty buffer
+		# add line to a buffer
+		if line!='': logservatory.buffer.append(line)
 
-			page_count = logservatory.get_db_stat('PRAGMA page_count')
-			database_size = page_size * page_count
+		# every buffer_size lines (or when the input is idle), process buffer
+		if len(logservatory.buffer) >= logservatory.buffer_size or (line=='' and len(logservatory.buffer)>0):
+			with logservatory.db_lock:
+				logservatory.ingest_logs()
+				logservatory.buffer = [] # empty buffer
+				ingested_offsets = dict(offsets)
 
-			if database_size > 0.9 * logservatory.memory: # some extra room for SQLite overheads
-				# delete oldest ~25% of log entries from the logs table
-				min_ts = logservatory.get_db_stat('SELECT MIN(timestamp) FROM logs')
-				avg_ts = logservatory.get_db_stat('SELECT AVG(timestamp) FROM logs')
-				target_ts = round((avg_ts+min_ts)/2)
-				cur = logservatory.connection.cursor()
-				cur.execute("DELETE FROM logs WHERE timestamp<"+str(target_ts))
-				logservatory.connection.commit()
+				page_count = logservatory.get_db_stat('PRAGMA page_count')
+				database_size = page_size * page_count
 
+				# (queries run over a copy of the database, so it gets memory's share of the copies, less some room for SQLite overheads)
+				if database_size * copies > 0.9 * logservatory.memory and logservatory.partition>0:
+					# drop the oldest partitions (whole tables, so the memory is actually freed)
+					logservatory.evict_partitions()
+				elif database_size * copies > 0.9 * logservatory.memory:
+					# delete oldest ~25% of log entries from the logs table
+					min_ts = logservatory.get_db_stat('SELECT MIN(timestamp) FROM logs')
+					avg_ts = logservatory.get_db_stat('SELECT AVG(timestamp) FROM logs')
+					target_ts = round((avg_ts+min_ts)/2)
+					cur = logservatory.connection.cursor()
+					cur.execute("DELETE FROM "+logservatory.data_table+" WHERE timestamp<"+str(target_ts))
+					logservatory.connection.commit()
+					logservatory.recount_db_stats()
+					if logservatory.compact: logservatory.prune_dictionaries()
 
-		# every period seconds, run queries
-		if int(time.time()) - last_run_timestamp >= logservatory.period:
-			logservatory.run_queries(mode='live')
-			last_run_timestamp = int(time.time())
-			logservatory.print_db_stats()
+	# input is done: ingest what's left and run the queries one last time
+	stop.set()
+	scheduler.join()
+	with logservatory.db_lock:
+		logservatory.ingest_logs()
+		logservatory.buffer = []
+		ingested_offsets = dict(offsets)
+	run_period(final=True)
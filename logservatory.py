@@ -1,6 +1,17 @@
-import os, re, sys, getopt, sqlite3, math, csv
-from datetime import datetime
+import os, re, sys, time, getopt, sqlite3, math, csv, json, pickle, random, bisect, calendar, collections, itertools, multiprocessing, threading
+import io, gzip, bz2, socket
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 from dateutil.parser import parse
+import sketches
+try:
+	import zstandard # optional, for .zst logs
+except ImportError:
+	zstandard = None
+try:
+	import pyarrow, pyarrow.parquet, pyarrow.ipc # optional, for Parquet and Arrow output
+except ImportError:
+	pyarrow = None
 #from csv import writer
 
 # default args / global variables:
@@ -11,24 +22,115 @@ format = 'aws-elb-classic' # or 'aws-elb-application', 'ncsa-common', 'ncsa-comb
 queries_file = '' # path to file with queries to run
 output = '' # path to directory for query output (queryN.csv)
 sample = 1.0 # what fraction of logs to sample and query over
+sample_mode = 'files' # how to sample: 'files' (uniformly), 'stratified' (files from every stratum), 'bytes' (files, by size), 'lines'
+stratum = 3600 # how many seconds each stratum of stratified sampling covers
 buffer_size = 100 # how large to let the log buffer get before ingesting it into SQLite
 memory = 100000000 # maximum amount of memory (in bytes) the system can use
 period = 60 # how many seconds to wait between successive query runs
 encoding = 'utf-8'
+workers = 1 # how many processes to parse log files with (for mode=logs)
+query_workers = 1 # how many queries to run at once, each over its own copy of the in-memory database
+partition = 60 # how many seconds of logs each partition table holds (for mode=live; 0 means one logs table)
+queue_size = 100000 # how many lines can wait between reading stdin and ingesting them (for mode=live)
+metrics_file = '' # where to export metrics (JSON lines, or a Prometheus textfile if it ends in .prom)
+prune = True # only store the columns the queries use, and drop lines no query can match
+merge = False # stage per-batch query results and merge them into one output per query at the end (for mode=logs)
+window = 0 # align historical batches to windows of this many seconds (for mode=logs; 0 means flush everything)
+compact = False # store IPs/status codes/ports as integers and repetitive strings in lookup tables
+output_format = 'csv' # format of the query outputs: 'csv', 'parquet' or 'arrow' (Arrow IPC file)
+fetch_rows = 65536 # query results are fetched (and written) this many rows at a time
+checkpoint_file = '' # where to save checkpoints to carry on from after a crash (with resume)
+resume = False # restore the database, outputs and position from checkpoint_file instead of starting over
+checkpoint_period = 300 # at most how often (in seconds) live.py saves a checkpoint
+follow = [] # glob patterns of log files to tail instead of reading stdin (for mode=live)
+overflow = 'block' # what to do with lines when that queue is full: 'block' (backpressure) or 'drop' (for mode=live)
 
 queries = []
+query_options = [] # per query, options set with directives in the queries file (like #merge:)
 buffer = []
 fields = []
 connection = ''
+parse_line = None # per-format line parser, built by start_database()
+insert_query = '' # per-format INSERT statement, built by start_database()
+logs_columns = '' # per-format column definitions of the logs table
+data_columns = '' # column definitions of the table(s) rows are stored in (differs from logs_columns with compact)
+data_table = 'logs' # the table (or, in live mode, view over partitions) rows are stored in; logs is a view over it with compact
+ip_columns = ['request_ip', 'backend_ip'] # stored as integers with compact
+integer_columns = ['request_port', 'backend_port', 'request_status_code', 'backend_status_code'] # stored as integers with compact
+dictionary_columns = ['elb_name', 'request_url', 'user_agent', 'referrer', 'ssl_cipher'] # stored as ids into dict_<column> with compact
+dictionaries = {} # column -> {value: id} for the dictionary columns present in the format
+next_ids = {} # column -> next unused dictionary id (ids aren't reused after pruning)
+pruned_sizes = {} # column -> dictionary size after it was last pruned
+prune_min_values = 10000 # dictionaries smaller than this aren't pruned
+ip_cache = {}
+timestamp_index = 0 # position of the timestamp in a parsed row
+kept_columns = None # positions of the columns the queries use (None: all), from analyze_queries()
+pushdown = [] # (position, operator, literal) conditions every row must pass: from analyze_queries(), and start/end
+index_db = False # whether index is a SQLite index (built with build-index.py --db), attached as idx
+partitions = {} # time bucket -> partition table name (for mode=live); each holds the buckets up to the next one's
+max_partitions = 400 # SQLite allows at most 500 terms in a compound SELECT (past this, partitions are coalesced)
+evicted_before = None # time bucket before which partitions have been evicted
+n_late = 0 # rows dropped because their partition was already evicted
+db_stats = {} # partition time bucket (None without partitions) -> [rows, min timestamp, max timestamp] of the rows stored
+metrics = collections.Counter() # counters and *_seconds timers of the ingest stages, exported by write_metrics()
+query_metrics = collections.defaultdict(collections.Counter) # query number -> seconds, rows and runs
+metrics_lock = threading.Lock()
+db_lock = threading.RLock() # live.py ingests, evicts and snapshots connection from different threads
+sketch_states = {} # (query number, incremental bucket, call, function, parameter, key) -> sketch merged over all batches/periods so far
+sketch_finalized = {} # the same -> the run (see start_sketch_run()) that last merged into it
+sketch_marks = {} # (live mode) query number -> timestamp up to which its rows are merged into its sketches
+sketch_upto = None # (live mode) ... as of the snapshot the queries run on
+sketch_run_count = 0
+rewritten_queries = {} # (query, mode) -> the query as it's run, see query_sql()
+sketch_lock = threading.RLock()
+query_pool = None # threads running queries when query_workers>1
+query_local = threading.local() # each query thread's copy of the database
+snapshot = None # serialized copy of the database the query threads are working on
+snapshot_id = 0
+staging = None # on-disk database of per-batch query results (with merge)
+staging_lock = threading.Lock()
+outputs = {} # query number -> output writer kept open for the whole run (for mode=logs)
+result_columns = {} # query number -> output column names of the #incremental: queries
+incremental_results = {} # query number -> {time bucket: result rows} of the #incremental: queries (for mode=live)
+incremental_offsets = {} # query number -> [(time bucket, offset in queryN.csv)] where each bucket's rows start
+changed_since = None # earliest timestamp inserted since mark_changes()
+changed_from = None # ... as of the last mark_changes(): incremental queries re-evaluate the buckets from there
+snapshot_range = (None, None) # timestamp range stored, as of the last mark_changes()
+snapshot_partitions = {} # partitions, as of the last mark_changes()
+planned_indexes = [] # ('data' for the logs table(s), or a dict_ table; column) indexes the queries use, from plan_indexes()
+index_overhead = 1.0 # how much larger the database gets when the planned indexes are built
+resume_state = None # the state saved with the checkpoint being resumed from
+last_checkpoint = 0.0
+
+# Note: for Python 2.7 compatibility, use ur"" to prefix the regex and u"" to prefix the test string and substitution.
+regexes = {
+	# REFERENCE: https://docs.aws.amazon.com/athena/latest/ug/application-load-balancer-logs.html#create-alb-table
+	'aws-elb-classic': re.compile(r'([^ ]*) ([^ ]*) ([^ ]*):([0-9]*) ([^ ]*)[:-]([0-9]*) ([-.0-9]*) ([-.0-9]*) ([-.0-9]*) (|[-0-9]*) (-|[-0-9]*) ([-0-9]*) ([-0-9]*) "([^ ]*) ([^ ]*) (- |[^ ]*)" ("[^\"]*") ([A-Z0-9-]+) ([A-Za-z0-9.-]*)$'),
+	'aws-elb-application': re.compile(r'([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*):([0-9]*) ([^ ]*)[:-]([0-9]*) ([-.0-9]*) ([-.0-9]*) ([-.0-9]*) (|[-0-9]*) (-|[-0-9]*) ([-0-9]*) ([-0-9]*) \"([^ ]*) ([^ ]*) (- |[^ ]*)\" \"([^\"]*)\" ([A-Z0-9-]+) ([A-Za-z0-9.-]*) ([^ ]*) \"([^\"]*)\" \"([^\"]*)\" \"([^\"]*)\" ([-.0-9]*) ([^ ]*) \"([^\"]*)\" \"([^\"]*)\" \"([^ ]*)\" \"([^\s]+?)\" \"([^\s]+)\" \"([^ ]*)\" \"([^ ]*)\"'),
+	'ncsa-common': re.compile(r'([(\d\.)]+) - (.*?) \[(.*?)\] "(.*?) (.*?) (.*?)" (\d+) (\d+)'),
+	'ncsa-combined': re.compile(r'([(\d\.)]+) - (.*?) \[(.*?)\] "(.*?) (.*?) (.*?)" (\d+) (\d+) "(.*?)" "(.*?)"'),
+}
+
+read_block_size = 1024 * 1024 # log files (compressed or not) are read in blocks of this many bytes
+row_expansion = 6 # parsed rows take roughly this many times the memory of the raw log lines
+line_sample = 1.0 # fraction of lines kept (and parsed) in each chunk (sample_mode 'lines')
+weighted = False # whether rows have a sample_weight column (when sampling, or when a query mentions it)
+pending_bytes = 0 # bytes of log lines read (or being read) but not yet inserted into SQLite
+
+months = {'Jan':1, 'Feb':2, 'Mar':3, 'Apr':4, 'May':5, 'Jun':6, 'Jul':7, 'Aug':8, 'Sep':9, 'Oct':10, 'Nov':11, 'Dec':12}
+ts_cache_size = 4096 # timestamps are cached per second, and logs are (mostly) in time order
+ncsa_ts_cache = {}
+elb_ts_cache = {}
 
 
 def parse_args(mode='live'):
-	global index, start, end, format, queries_file, output, sample, buffer_size, memory, period, queries, encoding
+	global index, start, end, format, queries_file, output, sample, buffer_size, memory, period, queries, encoding, workers, query_workers, partition, queue_size, overflow, compact, window, merge, prune, metrics_file, checkpoint_file, checkpoint_period, resume, sample_mode, stratum, output_format
 
 	if mode=='static':
-		opts_array = ["index=", "start=", "end=", "format=", "queries=", "output=", "buffer=", "memory=", "period=", "sample=", "encoding="]
+		buffer_size = 10000 # historical logs are read and inserted in larger batches
+		opts_array = ["index=", "start=", "end=", "format=", "queries=", "output=", "buffer=", "memory=", "period=", "sample=", "encoding=", "workers=", "query-workers=", "compact", "window=", "merge", "no-prune", "metrics=", "checkpoint=", "resume", "sample-mode=", "stratum=", "output-format="]
 	else:
-		opts_array = ["format=", "queries=", "output=", "buffer=", "memory=", "period=", "sample=", "encoding="]
+		opts_array = ["format=", "queries=", "output=", "buffer=", "memory=", "period=", "sample=", "encoding=", "query-workers=", "partition=", "queue=", "overflow=", "compact", "no-prune", "metrics=", "checkpoint=", "checkpoint-period=", "resume", "follow=", "output-format="]
 
 	# parse cli args:
 	argv = sys.argv[1:]
@@ -58,11 +160,45 @@ def parse_args(mode='live'):
 			period = arg
 		elif opt in ['--sample']:
 			sample = arg
+		elif opt in ['--sample-mode']:
+			sample_mode = arg
+		elif opt in ['--stratum']:
+			stratum = arg
 		elif opt in ['--encoding']:
 			encoding = arg
+		elif opt in ['--workers']:
+			workers = arg
+		elif opt in ['--query-workers']:
+			query_workers = arg
+		elif opt in ['--partition']:
+			partition = arg
+		elif opt in ['--queue']:
+			queue_size = arg
+		elif opt in ['--compact']:
+			compact = True
+		elif opt in ['--window']:
+			window = arg
+		elif opt in ['--merge']:
+			merge = True
+		elif opt in ['--no-prune']:
+			prune = False
+		elif opt in ['--metrics']:
+			metrics_file = arg
+		elif opt in ['--checkpoint']:
+			checkpoint_file = arg
+		elif opt in ['--checkpoint-period']:
+			checkpoint_period = arg
+		elif opt in ['--resume']:
+			resume = True
+		elif opt in ['--follow']:
+			follow.append(arg)
+		elif opt in ['--output-format']:
+			output_format = arg
+		elif opt in ['--overflow']:
+			overflow = arg
 
 def validate_args(mode='live'):
-	global index, start, end, format, queries_file, output, sample, buffer_size, memory, period, queries
+	global index, start, end, format, queries_file, output, sample, buffer_size, memory, period, queries, workers, query_workers, partition, queue_size, overflow, window, query_options, stratum, line_sample, checkpoint_period
 
 	# validate args:
 	if format!='aws-elb-classic' and format!='aws-elb-application' and format!='ncsa-common' and format!='ncsa-combined':
@@ -76,20 +212,79 @@ def validate_args(mode='live'):
 		fl = f.readlines()
 		f.close()
 		q = ''
+		options = {}
 		for x in fl:
 			if x.strip(" \n\t\r")=='##########':
 				queries.append(q.strip(" \n\t\r"))
+				query_options.append(options)
 				q = ''
+				options = {}
+			elif x[:7]=='#merge:':
+				options['merge'] = [c.strip(" \n\t\r").lower() for c in x[7:].split(',')]
+			elif x[:13]=='#incremental:':
+				options['incremental'] = x[13:].strip(" \n\t\r")
 			elif x[:1]=='#':
 				continue
 			else:
 				q = q + ' ' + x
 		if q!='':
 			queries.append(q.strip(" \n\t\r"))
+			query_options.append(options)
 	except Exception as e:
 		print(e)
 		print('Argument "queries" must be a valid query file. See the documentation for format details.')
 		exit()
+	for i in range(len(queries)):
+		if 'incremental' in query_options[i]:
+			try:
+				query_options[i]['incremental'] = int(query_options[i]['incremental'])
+			except:
+				query_options[i]['incremental'] = 0
+			if query_options[i]['incremental']<=0:
+				print('Query '+str(i)+' has an invalid "#incremental:" line. Give the time bucket (in seconds) the query groups by, like "#incremental: 60".')
+				exit()
+	if merge:
+		for i in range(len(queries)):
+			if 'merge' not in query_options[i]:
+				query_options[i]['merge'] = infer_combiners(queries[i])
+			combiners = query_options[i]['merge']
+			if combiners is None:
+				print('Query '+str(i)+' has aggregates (or HAVING, LIMIT, DISTINCT or window functions) that "merge" can\'t combine across batches by itself. Declare how to combine each output column with a "#merge:" line. See the documentation for details.')
+				exit()
+			for c in combiners:
+				if c not in ['key', 'sum', 'min', 'max', 'last'] and not (c[:4]=='avg@' and c[4:].isdigit() and int(c[4:])<len(combiners)):
+					print('Query '+str(i)+' has an invalid "#merge:" combiner "'+c+'". Use key, sum, min, max, last, or avg@N (N is the weight column).')
+					exit()
+			query_options[i]['order'] = order_by(queries[i])
+			if query_options[i]['order'] is None:
+				print('Query '+str(i)+' has an ORDER BY that "merge" can\'t apply again to the merged results. Order by output columns: by position (like ORDER BY 2 DESC), by name, or by the same expression as in the select list.')
+				exit()
+	if metrics_file!='' and not os.path.isdir(os.path.dirname(os.path.abspath(metrics_file))):
+		print('Argument "metrics" must be a file path in an existing directory. Metrics are written there as JSON lines, or as a Prometheus textfile if it ends in ".prom".')
+		exit()
+	if checkpoint_file!='' and not os.path.isdir(os.path.dirname(os.path.abspath(checkpoint_file))):
+		print('Argument "checkpoint" must be a file path in an existing directory.')
+		exit()
+	try:
+		checkpoint_period = int(checkpoint_period)
+	except:
+		print('Argument "checkpoint-period" (the seconds between live checkpoints) must be an integer.')
+		exit()
+	if checkpoint_period<=0:
+		print('Argument "checkpoint-period" (the seconds between live checkpoints) must be a positive integer.')
+		exit()
+	if resume and (checkpoint_file=='' or not os.path.exists(checkpoint_file)):
+		print('Argument "resume" needs the "checkpoint" file of an earlier run to resume from.')
+		exit()
+	if output_format not in ['csv', 'parquet', 'arrow']:
+		print('Argument "output-format" must be "csv", "parquet" or "arrow".')
+		exit()
+	if output_format!='csv' and pyarrow is None:
+		print('Argument "output-format" "' + output_format + '" requires the pyarrow package (pip install pyarrow).')
+		exit()
+	if output_format!='csv' and mode=='static' and checkpoint_file!='':
+		print('Argument "checkpoint" works with "output-format" "csv" only in historical.py (Parquet and Arrow files can\'t be truncated back to a checkpoint).')
+		exit()
 	if not os.path.isdir(output):
 		print('Argument "output" must be a directory. Query results will output here, one CSV file per query.')
 		exit()
@@ -121,6 +316,59 @@ def validate_args(mode='live'):
 		print('Argument "period" (the processing period) must be a positive integer.')
 		exit()
 
+	try:
+		workers = int(workers)
+	except:
+		print('Argument "workers" (the number of parsing processes) must be an integer.')
+		exit()
+	if workers<=0:
+		print('Argument "workers" (the number of parsing processes) must be a positive integer.')
+		exit()
+
+	try:
+		query_workers = int(query_workers)
+	except:
+		print('Argument "query-workers" (the number of queries to run at once) must be an integer.')
+		exit()
+	if query_workers<=0:
+		print('Argument "query-workers" (the number of queries to run at once) must be a positive integer.')
+		exit()
+	if query_workers>1 and not hasattr(sqlite3.Connection, 'serialize'):
+		print('Argument "query-workers" requires Python 3.11 or later (for sqlite3 serialize/deserialize).')
+		exit()
+
+	if mode=='static':
+		partition = 0 # historical batches are emptied all at once
+	try:
+		partition = int(partition)
+	except:
+		print('Argument "partition" (the partition size in seconds) must be an integer.')
+		exit()
+	if partition<0:
+		print('Argument "partition" (the partition size in seconds) must be a positive integer, or 0 for no partitioning.')
+		exit()
+
+	try:
+		queue_size = int(queue_size)
+	except:
+		print('Argument "queue" (the input queue size) must be an integer.')
+		exit()
+	if queue_size<=0:
+		print('Argument "queue" (the input queue size) must be a positive integer.')
+		exit()
+	if overflow!='block' and overflow!='drop':
+		print('Argument "overflow" must be "block" (slow down the input when the queue is full) or "drop" (discard lines when the queue is full).')
+		exit()
+
+	try:
+		window = int(window)
+	except:
+		print('Argument "window" (the query time window in seconds) must be an integer.')
+		exit()
+	if window<0:
+		print('Argument "window" (the query time window in seconds) must be a positive integer, or 0 to not align batches.')
+		exit()
+
 	if start!='':
 		try:
 			start = datetime.timestamp(parse(start))
@@ -143,12 +391,32 @@ def validate_args(mode='live'):
 	if sample<=0 or sample>1:
 		print('Argument "sample" (the sample rate) must be a float between 0 and 1. To query over all logs (and not sample), leave out this Argument.')
 		exit()
+	if sample_mode not in ['files', 'stratified', 'bytes', 'lines']:
+		print('Argument "sample-mode" must be "files", "stratified", "bytes" or "lines". See the documentation for details.')
+		exit()
+	if sample_mode=='lines': line_sample = sample
+	try:
+		stratum = int(stratum)
+	except:
+		print('Argument "stratum" (the stratum size in seconds for stratified sampling) must be an integer.')
+		exit()
+	if stratum<=0:
+		print('Argument "stratum" (the stratum size in seconds for stratified sampling) must be a positive integer.')
+		exit()
 
 
 def start_database():
-	global connection, format, fields
-	connection = sqlite3.connect(':memory:')
+	global connection, format, fields, parse_line, insert_query, logs_columns, data_columns, data_table, timestamp_index, dictionaries, next_ids, kept_columns, pushdown, weighted
+	connection = sqlite3.connect(':memory:', check_same_thread=False) # (guarded by db_lock in live.py)
+	db_stats.clear()
+	register_functions(connection)
 	c = connection.cursor()
+	if partition>0:
+		# return the pages of dropped partitions to the OS instead of keeping them on a free-list
+		c.execute("PRAGMA auto_vacuum = FULL")
+	# bulk loading a throwaway database: no rollback journal, and sorts (like index builds) in memory
+	c.execute("PRAGMA main.journal_mode = OFF")
+	c.execute("PRAGMA temp_store = MEMORY")
 
 	# 1. create logs table based on log format
 	if format=='aws-elb-classic':
@@ -158,12 +426,12 @@ def start_database():
 			"request_verb", "request_url", "request_protocol", "user_agent",
 			"ssl_cipher", "ssl_protocol",
 		]
-		c.execute("""CREATE TABLE IF NOT EXISTS logs (
+		logs_columns = """
 timestamp int,  elb_name string, request_ip string, request_port int, backend_ip string, backend_port int,
 request_processing_time double, backend_processing_time double, client_response_time double,
 request_status_code string, backend_status_code string, received_bytes bigint, sent_bytes bigint,
 request_verb string, request_url string, request_protocol string, user_agent string, ssl_cipher string,
-ssl_protocol string) """)
+ssl_protocol string"""
 
 	if format=='aws-elb-application':
 		fields = ["type", "timestamp", "elb", "client_ip", "client_port", "backend_ip", "backend_port",
@@ -172,161 +440,1837 @@ ssl_protocol string) """)
 			"request_verb", "request_url", "request_protocol", "user_agent",
 			"ssl_cipher", "ssl_protocol",
 		]
-		c.execute("""CREATE TABLE IF NOT EXISTS logs (
+		logs_columns = """
 timestamp int,  elb_name string, request_ip string, request_port int, backend_ip string, backend_port int,
 request_processing_time double, backend_processing_time double, client_response_time double,
 request_status_code string, backend_status_code string, received_bytes bigint, sent_bytes bigint,
 request_verb string, request_url string, request_protocol string, user_agent string, ssl_cipher string,
-ssl_protocol string) """)
+ssl_protocol string"""
 
 	if format=='ncsa-common':
 		fields = ["request_ip", "auth_user", "timestamp", "request_verb", "request_url", "request_protocol",
 			"request_status_code", "sent_bytes",
 		]
-		c.execute("""CREATE TABLE IF NOT EXISTS logs (
+		logs_columns = """
 request_ip string, auth_user string, timestamp int, request_verb string, request_url string,
-request_protocol string, request_status_code string, sent_bytes bigint) """)
+request_protocol string, request_status_code string, sent_bytes bigint"""
 
 	if format=='ncsa-combined':
 		fields = ["request_ip", "auth_user", "timestamp", "request_verb", "request_url", "request_protocol",
 			"request_status_code", "sent_bytes", "referrer", "user_agent"
 		]
-		c.execute("""CREATE TABLE IF NOT EXISTS logs (
+		logs_columns = """
 request_ip string, auth_user string, timestamp int, request_verb string, request_url string,
 request_protocol string, request_status_code string, sent_bytes bigint, referrer string,
-user_agent string) """)
-		c.execute("""CREATE INDEX timestamp_idx ON logs (timestamp)""")
+user_agent string"""
+
+	timestamp_index = get_timestamp_index(format)
+
+	# (the parsed columns, then the weight of each row when sampling: 1/probability it was sampled; left out
+	# otherwise, so that SELECT * has the same columns as without sampling, unless a query asks for it)
+	weighted = sample<1.0 or any(re.search(r'\bsample_weight\b', q, re.I) for q in queries)
+	weight_column = ", sample_weight double" if weighted else ""
+	data_columns = logs_columns + weight_column
+	data_table = 'logs'
+	if compact:
+		# store rows in logs_data, with smaller types and lookup tables, behind a logs view that decodes them
+		data_table = 'logs_data'
+		definitions = []
+		dictionaries = {}
+		for name, type in [column.split() for column in logs_columns.split(",")]:
+			if name in ip_columns or name in integer_columns or name in dictionary_columns:
+				type = 'int'
+			if name in dictionary_columns:
+				dictionaries[name] = {}
+				next_ids[name] = 1
+				c.execute("CREATE TABLE dict_" + name + " (id integer primary key, value string) ")
+			definitions.append(name + " " + type)
+		data_columns = ", ".join(definitions) + weight_column
+
+	if partition>0:
+		# in live mode, rows are stored in time-bucketed partition tables (see insert_rows()) behind a view
+		c.execute("CREATE TABLE logs_empty (" + data_columns + ") ")
+		create_logs_view()
+	else:
+		c.execute("CREATE TABLE IF NOT EXISTS " + data_table + " (" + data_columns + ") ")
+	if compact:
+		create_compact_view()
+
+	# 2. build the line parser and insert statement for this format
+	if prune: kept_columns, pushdown = analyze_queries(queries)
+	if start!='': pushdown.append((timestamp_index, '>=', start))
+	if end!='': pushdown.append((timestamp_index, '<=', end))
+	parse_line = prune_parser(make_parser(format), kept_columns, pushdown)
+	plan_indexes()
+	insert_query = "INSERT INTO {table} VALUES ( " + ", ".join(["?"] * (len(logs_columns.split(",")))) + (", {weight} )" if weighted else " )")
+
+	connection.commit()
+
+
+def create_logs_view():
+	global connection, partitions
+	cur = connection.cursor()
+	cur.execute("DROP VIEW IF EXISTS " + data_table)
+	if len(partitions)>0:
+		cur.execute("CREATE VIEW " + data_table + " AS " + " UNION ALL ".join(["SELECT * FROM " + partitions[b] for b in sorted(partitions)]))
+	else:
+		cur.execute("CREATE VIEW " + data_table + " AS SELECT * FROM logs_empty")
+
+
+def create_compact_view():
+	# logs view with the same columns (and values) as the regular logs table, over compact logs_data
+	global connection
+	cur = connection.cursor()
+	cur.execute("CREATE VIEW logs AS " + compact_select("logs_data"))
+
+
+def compact_select(source):
+	# SELECT decoding the compact rows of source (a table, or a subquery in parentheses)
+	select = []
+	joins = []
+	for name in [column.split()[0] for column in logs_columns.split(",")]:
+		if name in dictionaries:
+			select.append("dict_" + name + ".value AS " + name)
+			joins.append(" LEFT JOIN dict_" + name + " ON dict_" + name + ".id=logs_data." + name)
+		elif name in ip_columns:
+			select.append("ip_text(logs_data." + name + ") AS " + name)
+		else:
+			select.append("logs_data." + name + " AS " + name)
+	if weighted: select.append("logs_data.sample_weight AS sample_weight")
+	return "SELECT " + ", ".join(select) + " FROM " + source + " AS logs_data" + "".join(joins)
+
+
+def ip_number(ip):
+	# dotted IPv4 address -> integer (anything else, like IPv6 or '', is stored as is)
+	n = ip_cache.get(ip)
+	if n is None:
+		n = ip
+		if ip.count('.')==3:
+			try: n = int.from_bytes(socket.inet_aton(ip), 'big')
+			except OSError: pass
+		if len(ip_cache)>=65536: ip_cache.clear()
+		ip_cache[ip] = n
+	return n
+
+
+def ip_text(n):
+	# (SQL function) integer -> dotted IPv4 address
+	if isinstance(n, int): return socket.inet_ntoa(n.to_bytes(4, 'big'))
+	return n
+
+
+def integer(value):
+	try: return int(value)
+	except (ValueError, TypeError): return value
+
+
+def encode_rows(rows):
+	# convert parsed rows to compact storage, adding new dictionary values to their lookup tables
+	global connection
+	conversions = []
+	for i, name in enumerate([column.split()[0] for column in logs_columns.split(",")]):
+		if name in ip_columns: conversions.append((i, ip_number, None))
+		elif name in integer_columns: conversions.append((i, integer, None))
+		elif name in dictionaries: conversions.append((i, None, name))
+	new_values = collections.defaultdict(list)
+	encoded = []
+	for row in rows:
+		row = list(row)
+		for i, convert, name in conversions:
+			value = row[i]
+			if value is None: continue
+			if convert is not None:
+				row[i] = convert(value)
+			else:
+				id = dictionaries[name].get(value)
+				if id is None:
+					id = dictionaries[name][value] = next_ids[name]
+					next_ids[name] += 1
+					new_values[i].append((id, value))
+				row[i] = id
+		encoded.append(row)
+	cur = connection.cursor()
+	names = [column.split()[0] for column in logs_columns.split(",")]
+	for i, values in new_values.items():
+		cur.executemany("INSERT INTO dict_" + names[i] + " VALUES (?, ?)", values)
+	return encoded
+
+
+def prune_dictionaries():
+	# after rows are deleted: drop dictionary values no row refers to any more, and reload the ids. That
+	# scans every row (holding db_lock in live.py), so a dictionary is only pruned once it has doubled
+	# since it last was, rather than at every eviction
+	global connection, dictionaries
+	cur = connection.cursor()
+	for name in dictionaries:
+		if len(dictionaries[name]) < max(prune_min_values, 2 * pruned_sizes.get(name, 0)): continue
+		cur.execute("DELETE FROM dict_" + name + " WHERE id NOT IN (SELECT " + name + " FROM " + data_table + " WHERE " + name + " IS NOT NULL)")
+		dictionaries[name] = dict((value, id) for id, value in cur.execute("SELECT id, value FROM dict_" + name))
+		pruned_sizes[name] = len(dictionaries[name])
+	connection.commit()
+
+
+def hold_partial_window():
+	# before a historical batch is queried: take the rows of the last, incomplete window out of the
+	# database (they're returned, to be inserted again for the next batch), so queries grouping by
+	# window see each window whole. If the batch holds no complete window, everything is queried.
+	global connection
+	if window<=0 or None not in db_stats: return []
+	n_rows, min_ts, max_ts = db_stats[None]
+	boundary = int(max_ts) // window * window
+	if min_ts>=boundary: return []
+	cur = connection.cursor()
+	rows = cur.execute("SELECT * FROM logs WHERE timestamp>=" + str(boundary)).fetchall()
+	cur.execute("DELETE FROM " + data_table + " WHERE timestamp>=" + str(boundary))
+	connection.commit()
+	# (the stats are updated rather than recounted: what's left ends, at the latest, with the last whole window)
+	db_stats[None] = [n_rows - len(rows), min_ts, boundary - 1]
+	metrics['rows_ingested'] -= len(rows) # (they're inserted again with the next batch)
+	return rows
 
+
+def clear_logs():
+	# empty the logs (and their dictionaries, with compact) between historical batches
+	global connection, dictionaries
+	cur = connection.cursor()
+	for table, column in planned_indexes:
+		# (the next batch is loaded without them, see build_indexes())
+		cur.execute("DROP INDEX IF EXISTS " + (data_table if table=='data' else table) + "_" + column + "_idx")
+	cur.execute("DELETE FROM " + data_table)
+	db_stats.clear()
+	for name in dictionaries:
+		cur.execute("DELETE FROM dict_" + name)
+		dictionaries[name] = {}
+		next_ids[name] = 1
 	connection.commit()
+	get_db_stat("vacuum")
+
+
+def plan_indexes():
+	# the indexes the queries would use: EXPLAIN QUERY PLAN of each query over an empty copy of the schema
+	# with an index on every column, keeping those SQLite would search with (not those it could only scan
+	# in order, which on a large table is slower than sorting)
+	global planned_indexes
+	scratch = sqlite3.connect(':memory:')
+	register_functions(scratch)
+	candidates = {}
+	for type, name, sql in connection.execute("SELECT type, name, sql FROM sqlite_master WHERE type IN ('table', 'view') ORDER BY type='view'").fetchall():
+		scratch.execute(sql)
+		if type!='table': continue
+		for column in [row[1] for row in scratch.execute("PRAGMA table_info(" + name + ")").fetchall()]:
+			if column=='id': continue # (dict_ ids are the primary key already)
+			index = 'plan_' + str(len(candidates))
+			scratch.execute("CREATE INDEX " + index + " ON " + name + " (" + column + ")")
+			candidates[index] = ('data' if name in [data_table, 'logs_empty'] else name, column)
+	planned = set()
+	for query in queries:
+		try:
+			plan = scratch.execute("EXPLAIN QUERY PLAN " + query).fetchall()
+		except sqlite3.Error:
+			continue # (like a query with parameters)
+		for row in plan:
+			m = re.search(r'\bSEARCH .* USING (?:COVERING )?INDEX (plan_[0-9]+)\b', row[-1])
+			if m is not None: planned.add(candidates[m.group(1)])
+	if any('incremental' in options for options in query_options):
+		planned.add(('data', 'timestamp')) # (incremental queries read one time bucket at a time)
+	# every stored row has the value of a pushed-down = condition, so an index on it can't narrow anything down
+	names = [column.split()[0] for column in logs_columns.split(",")]
+	planned -= set(('data', names[i]) for i, op, literal in pushdown if op=='=')
+	scratch.close()
+	planned_indexes = sorted(planned)
+
+
+def build_indexes():
+	# create the planned indexes that don't exist yet, just before the queries run: one sorted build
+	# after the rows are loaded is much cheaper than updating the indexes row by row while inserting
+	global index_overhead
+	if len(planned_indexes)==0: return
+	started = time.perf_counter()
+	pages = get_db_stat('PRAGMA page_count')
+	cur = connection.cursor()
+	for table, column in planned_indexes:
+		for t in ((list(partitions.values()) if partition>0 else [data_table]) if table=='data' else [table]):
+			cur.execute("CREATE INDEX IF NOT EXISTS " + t + "_" + column + "_idx ON " + t + " (" + column + ")")
+	connection.commit()
+	if partition<=0 and db_range()[0]>0:
+		# (historical batches are loaded without indexes, so leave room for them: see memory_estimate())
+		index_overhead = max(index_overhead, get_db_stat('PRAGMA page_count') / pages)
+	metrics['index_seconds'] += time.perf_counter() - started
+
+
+def create_partition(bucket):
+	global connection, partitions
+	table = 'logs_' + str(bucket)
+	cur = connection.cursor()
+	cur.execute("CREATE TABLE " + table + " (" + data_columns + ") ")
+	partitions[bucket] = table
+	# keep the view under SQLite's limit on compound SELECTs
+	while len(partitions)>max_partitions:
+		coalesce_partitions()
+	create_logs_view()
+
+
+def partition_key(bucket):
+	# the partition holding a time bucket: its own, or (between partitions) the one before it, which may
+	# have been coalesced over it. None if it needs a new partition, or was evicted.
+	if bucket in partitions: return bucket
+	if evicted_before is not None and bucket<evicted_before: return None
+	keys = sorted(partitions)
+	if len(keys)==0 or bucket<keys[0] or bucket>keys[-1]: return None
+	return keys[bisect.bisect(keys, bucket) - 1]
+
+
+def coalesce_partitions():
+	# (at max_partitions) merge the two neighbouring partitions spanning the fewest time buckets together
+	# (the oldest, of equal ones) into one, so partitions get wider with age and retention stays up to memory
+	global connection, partitions
+	keys = sorted(partitions)
+	i = min(range(len(keys) - 2), key=lambda i: keys[i+2] - keys[i]) # (not the newest, still being filled)
+	first, second = keys[i], keys[i+1]
+	cur = connection.cursor()
+	cur.execute("INSERT INTO " + partitions[first] + " SELECT * FROM " + partitions[second])
+	cur.execute("DROP TABLE " + partitions[second])
+	del partitions[second]
+	stats = db_stats.pop(second, None)
+	if stats is not None and first in db_stats:
+		db_stats[first] = [db_stats[first][0] + stats[0], min(db_stats[first][1], stats[1]), max(db_stats[first][2], stats[2])]
+	elif stats is not None:
+		db_stats[first] = stats
+	metrics['partitions_coalesced'] += 1
+
+
+def drop_partition(bucket):
+	global connection, partitions, evicted_before
+	cur = connection.cursor()
+	cur.execute("DROP TABLE " + partitions[bucket])
+	del partitions[bucket]
+	db_stats.pop(bucket, None)
+	# (the buckets it held: up to the next partition's)
+	end = min([b for b in partitions if b>bucket], default=bucket + 1)
+	if evicted_before is None or end>evicted_before: evicted_before = end
+	metrics['partitions_evicted'] += 1
+
+
+def evict_partitions():
+	# drop whole partitions, oldest first, until the database (and its query snapshots) are back under ~75% of memory
+	global connection, partitions
+	page_size = get_db_stat('PRAGMA page_size')
+	n_dropped = 0
+	while len(partitions)>1 and page_size * get_db_stat('PRAGMA page_count') * snapshot_copies() > 0.75 * memory:
+		drop_partition(min(partitions))
+		connection.commit()
+		n_dropped += 1
+	if n_dropped>0:
+		create_logs_view()
+		connection.commit()
+		if compact: prune_dictionaries()
+
+
+def is_sqlite(path):
+	with open(path, 'rb') as f:
+		return f.read(16)==b'SQLite format 3\x00'
 
 
 def load_index():
-	global connection, index
+	global connection, index, index_db
 	cur = connection.cursor()
-	cur.execute("""CREATE TABLE logs_idx (file string, size_bytes bigint,
-			n_lines bigint, min_ts bigint, max_ts bigint)""")
+	if is_sqlite(index):
+		# a SQLite index is used where it is, without loading it
+		cur.execute("ATTACH DATABASE ? AS idx", (index,))
+		index_db = True
+		return
+	# (a temporary table, so it isn't copied into query snapshots and checkpoints)
+	cur.execute("""CREATE TEMP TABLE logs_idx (id integer primary key, file string, size_bytes bigint,
+			n_lines bigint, min_ts bigint, max_ts bigint, uncompressed_bytes bigint)""")
 
 	with open(index,'r') as fin:
 		dr = csv.DictReader(fin)
-		to_db = [(i['file'], i['size_bytes'], i['n_lines'], i['min_ts'], i['max_ts']) for i in dr]
+		# (indexes built before compression support have no uncompressed_bytes column)
+		to_db = [(i['file'], i['size_bytes'], i['n_lines'], i['min_ts'], i['max_ts'], i.get('uncompressed_bytes') or i['size_bytes']) for i in dr]
 
-	cur.executemany("INSERT INTO logs_idx (file, size_bytes, n_lines, min_ts, max_ts) VALUES (?, ?, ?, ?, ?);", to_db)
+	cur.executemany("INSERT INTO logs_idx (file, size_bytes, n_lines, min_ts, max_ts, uncompressed_bytes) VALUES (?, ?, ?, ?, ?, ?);", to_db)
 	connection.commit()
 
 
 def fetch_log_files():
+	# index rows (file, size_bytes, n_lines, min_ts, max_ts, uncompressed_bytes, id, sample weight) of the
+	# files overlapping [start, end], or of the sample of them (see sample_files())
 	global connection, start, end, sample
 	cur = connection.cursor()
-	count_query = "SELECT COUNT(*) FROM logs_idx"
-	if start!='' and end!='':
-		count_query += """ WHERE
-			( min_ts>=""" + str(int(start)) + """ AND max_ts<=""" + str(int(end)) + """ )
-			OR ( min_ts<=""" + str(int(start)) + """ AND max_ts>=""" + str(int(start)) + """ )
-			OR ( min_ts<=""" + str(int(end)) + """ AND max_ts>=""" + str(int(end)) + """ ) """
-	elif start!='':
-		count_query += " WHERE max_ts>="+str(int(start))
-	elif end!='':
-		count_query += " WHERE min_ts<="+str(int(end))
-	cur.execute(count_query)
+	conditions = []
+	if start!='': conditions.append("max_ts>=" + str(int(start)))
+	if end!='': conditions.append("min_ts<=" + str(math.ceil(end)))
+	columns = "file, size_bytes, n_lines, min_ts, max_ts, uncompressed_bytes, id"
+	if index_db and len(conditions)>0:
+		# interval lookup in the r-tree, then the exact test (r-tree bounds are rounded outwards)
+		files = "SELECT i." + columns.replace(", ", ", i.") + " FROM idx.logs_idx_range r JOIN idx.logs_idx i ON i.id=r.id WHERE " + " AND ".join(["r." + c for c in conditions] + ["i." + c for c in conditions])
+	else:
+		files = "SELECT " + columns + " FROM " + ("idx.logs_idx" if index_db else "logs_idx")
+		if len(conditions)>0: files += " WHERE " + " AND ".join(conditions)
+	cur.execute("SELECT * FROM ( " + files + " ) ORDER BY min_ts ASC, max_ts ASC, file ASC")
 	rows = cur.fetchall()
-	num_rows = rows[0][0]
+	if resume_state is not None and resume_state.get('files') is not None:
+		# carry on with the same sample of files as the run being resumed
+		weights = dict(resume_state['files'])
+		rows = [row + (weights[row[0]],) for row in rows if row[0] in weights]
+	else:
+		rows = sample_files(rows)
+	if resume_state is not None:
+		position = resume_state.get('position')
+		if position is not None and (position[0]>=len(rows) or rows[position[0]][0]!=position[1]):
+			print('The log files to process have changed since the checkpoint was saved (check "index", "start" and "end"), so the run can\'t be resumed.')
+			exit()
+	return rows
+
+
+def sample_files(rows):
+	# the sampled index rows (in index order), each with its sample weight: the inverse of the probability
+	# it was picked, so that SUM(sample_weight) estimates COUNT(*) over all of the logs
+	if sample>=1.0: return [row + (1.0,) for row in rows]
+	if sample_mode=='lines':
+		# every file, and line_sample of the lines in each (see parse_chunk())
+		return [row + (1.0 / sample,) for row in rows]
+	if sample_mode=='bytes':
+		# each file independently, with probability proportional to its (uncompressed) size
+		total = sum(int(row[5]) for row in rows)
+		sampled = []
+		for row in rows:
+			p = min(1.0, sample * len(rows) * int(row[5]) / total) if total>0 else 0
+			if p>0 and random.random()<p: sampled.append(row + (1.0 / p,))
+		return sampled
+	if sample_mode=='stratified':
+		# files starting in each stratum seconds are sampled separately, at least one from each
+		strata = collections.defaultdict(list)
+		for i, row in enumerate(rows): strata[int(row[3]) // stratum].append(i)
+	else:
+		strata = {None: range(len(rows))}
+	weights = {}
+	for stratum_rows in strata.values():
+		k = max(1, round(sample * len(stratum_rows))) if sample_mode=='stratified' else math.ceil(sample * len(stratum_rows))
+		for i in random.sample(stratum_rows, k): weights[i] = len(stratum_rows) / k
+	return [row + (weights[i],) for i, row in enumerate(rows) if i in weights]
+
+
+def file_range(log_idx_row):
+	# (first, stop) byte offsets of a file that can hold lines in [start, end]: from the index's
+	# checkpoints, one checkpoint further out on each side in case lines are slightly out of order
+	first = 0
+	stop = None # (to the end of the file)
+	if not index_db or len(log_idx_row)<7: return first, stop
 	cur = connection.cursor()
-	if sample<1.0:
-		query = """SELECT * FROM ( """ + count_query.replace("COUNT(*)","*") + """
-			ORDER BY RANDOM() LIMIT """ + str(math.ceil(sample*num_rows)) + """
-			) ORDER BY min_ts ASC, max_ts ASC, file ASC"""
+	if start!='':
+		cur.execute("SELECT offset FROM idx.checkpoints WHERE file_id=? AND ts<? ORDER BY offset DESC LIMIT 1 OFFSET 1", (log_idx_row[6], start))
+		row = cur.fetchone()
+		if row is not None: first = row[0]
+	if end!='':
+		cur.execute("SELECT offset FROM idx.checkpoints WHERE file_id=? AND ts>? ORDER BY offset LIMIT 1 OFFSET 1", (log_idx_row[6], end))
+		row = cur.fetchone()
+		if row is not None: stop = row[0]
+	return first, stop
+
+
+def parse_ncsa_timestamp(ts):
+	# fixed layout "10/Oct/2000:13:55:36 -0700", falling back to dateutil for anything else
+	t = ncsa_ts_cache.get(ts)
+	if t is None:
+		started = time.perf_counter()
+		try:
+			if len(ts)!=26 or ts[2]!='/' or ts[6]!='/' or ts[11]!=':' or ts[20]!=' ' or ts[21] not in '+-':
+				raise ValueError(ts)
+			offset = int(ts[22:24])*3600 + int(ts[24:26])*60
+			if ts[21]=='-': offset = -offset
+			t = calendar.timegm((int(ts[7:11]), months[ts[3:6]], int(ts[0:2]), int(ts[12:14]), int(ts[15:17]), int(ts[18:20]))) - offset
+		except (ValueError, KeyError):
+			try: t = int(datetime.timestamp(parse(ts.replace(':',' ',1))))
+			except (ValueError, OverflowError): return None
+		if len(ncsa_ts_cache)>=ts_cache_size: ncsa_ts_cache.clear()
+		ncsa_ts_cache[ts] = t
+		metrics['timestamp_seconds'] += time.perf_counter() - started
+	return t
+
+
+def parse_elb_timestamp(ts):
+	# fixed layout "2015-05-13T23:39:43.945958Z" (UTC), cached on the second
+	key = ts[:19]
+	t = elb_ts_cache.get(key)
+	if t is None:
+		started = time.perf_counter()
+		try:
+			if len(ts)<20 or ts[4]!='-' or ts[7]!='-' or ts[10]!='T' or ts[13]!=':' or ts[16]!=':' or ts[-1]!='Z':
+				raise ValueError(ts)
+			t = calendar.timegm((int(ts[0:4]), int(ts[5:7]), int(ts[8:10]), int(ts[11:13]), int(ts[14:16]), int(ts[17:19])))
+		except ValueError:
+			try:
+				d = parse(ts)
+				if d.tzinfo is None: d = d.replace(tzinfo=timezone.utc)
+				return int(d.timestamp())
+			except (ValueError, OverflowError): return None
+		if len(elb_ts_cache)>=ts_cache_size: elb_ts_cache.clear()
+		elb_ts_cache[key] = t
+		metrics['timestamp_seconds'] += time.perf_counter() - started
+	return t
+
+
+def make_parser(fmt):
+	# returns a function mapping one log line to a row of values for the logs table (or None if it doesn't parse)
+	regex = regexes[fmt]
+
+	if fmt=='aws-elb-classic' or fmt=='aws-elb-application':
+		skip = 1 if fmt=='aws-elb-application' else 0 # leading "type" field
+		quoted_agent = fmt=='aws-elb-classic' # (the classic format keeps the quotes around the user agent)
+
+		def parse_regex(line):
+			matches = regex.search(line)
+			if not matches: return None
+			values = list(matches.groups()[skip:skip+19])
+			values[0] = parse_elb_timestamp(values[0])
+			if values[0] is None: return None
+			return values
+
+		def parse_elb(line):
+			# ELB logs are space-delimited around two quoted fields (request and user agent), so split
+			# instead of matching a regex; anything unusual falls back to the regex
+			line = line.strip()
+			segments = line.split('"', 4)
+			if len(segments)!=5 or segments[2]!=' ': return parse_regex(line)
+			parts = segments[0].split(' ')
+			request = segments[1].split(' ')
+			tail = segments[4].split(' ', 3)
+			if len(parts)!=12+skip or len(tail)<3 or tail[0]!='' or (not skip and len(tail)!=3): return parse_regex(line)
+			if len(request)==3: verb, url, protocol = request
+			elif len(request)==4 and request[2]=='-' and request[3]=='': verb, url, protocol = request[0], request[1], '- '
+			else: return parse_regex(line)
+			client_ip, sep, client_port = parts[2+skip].rpartition(':')
+			if not sep: return parse_regex(line)
+			backend = parts[3+skip]
+			if backend=='-':
+				backend_ip = backend_port = ''
+			else:
+				backend_ip, sep, backend_port = backend.rpartition(':')
+				if not sep: return parse_regex(line)
+			ts = parse_elb_timestamp(parts[skip])
+			if ts is None: return None
+			if quoted_agent: user_agent = '"' + segments[3] + '"'
+			else: user_agent = segments[3]
+			return (ts, parts[1+skip], client_ip, client_port, backend_ip, backend_port,
+				parts[4+skip], parts[5+skip], parts[6+skip], parts[7+skip], parts[8+skip], parts[9+skip], parts[10+skip],
+				verb, url, protocol, user_agent, tail[1], tail[2])
+
+		return parse_elb
+
+	def parse_ncsa(line):
+		matches = regex.search(line.strip())
+		if not matches: return None
+		values = list(matches.groups())
+		values[2] = parse_ncsa_timestamp(values[2])
+		if values[2] is None: return None
+		return values
+
+	return parse_ncsa
+
+
+def analyze_queries(query_list):
+	# which logs columns the queries reference (by name, anywhere in their text; all of them with
+	# SELECT *), and which simple WHERE conditions (column = literal, column LIKE literal) every
+	# query has, so that lines failing them can be dropped before insert
+	names = [column.split()[0] for column in logs_columns.split(",")]
+	text = " ".join(query_list).lower()
+	if re.search(r'(\bselect|,|\.)\s*\*', text): kept = None
 	else:
-		query = count_query.replace("COUNT(*)","*") + " ORDER BY min_ts ASC, max_ts ASC, file ASC"
-	cur.execute(query)
-	rows = cur.fetchall()
+		used = set(re.findall(r'[a-z_][a-z0-9_]*', text))
+		kept = [i for i, name in enumerate(names) if name in used or i==timestamp_index]
+		if len(kept)==len(names): kept = None
+
+	common = None
+	for query in query_list:
+		conditions = set(where_conditions(query))
+		common = conditions if common is None else common & conditions
+	conditions = []
+	for name, op, literal in sorted(common or []):
+		i = names.index(name) if name in names else -1
+		if i<0: continue
+		if op=='like' and logs_columns.split(",")[i].split()[1]!='string': continue
+		conditions.append((i, op, literal))
+	return kept, conditions
+
+
+def where_conditions(query):
+	# the top-level AND-ed (column, operator, literal) conditions of a plain "SELECT ... FROM logs WHERE ..."
+	# query; anything more complex (joins, subqueries, unions, CTEs) gives none
+	lower = query.lower()
+	if len(re.findall(r'\bselect\b', lower))!=1 or re.search(r'\b(join|union|intersect|except|with)\b', lower): return []
+	m = re.search(r'\bfrom\s+logs\s+where\s+(.*?)(\s+group\s+by\b|\s+order\s+by\b|\s+limit\b|\s+window\b|;|$)', query, re.I | re.S)
+	if m is None: return []
+	clause = m.group(1)
+	conjuncts = []
+	depth = 0
+	quote = False
+	start = 0
+	top = [] # (the clause outside quotes and parentheses)
+	for i, ch in enumerate(clause):
+		if ch=="'": quote = not quote
+		elif quote: continue
+		elif ch=='(': depth += 1
+		elif ch==')': depth -= 1
+		elif depth==0:
+			top.append(ch)
+			if re.match(r'\sand\s', clause[i:i+5], re.I):
+				conjuncts.append(clause[start:i])
+				start = i + 4
+	conjuncts.append(clause[start:])
+	# (only a plain AND chain is safe: with OR or NOT, a row can fail a conjunct and still match)
+	if re.search(r'\b(or|not)\b', ''.join(top), re.I): return []
+	conditions = []
+	for c in conjuncts:
+		m = re.match(r"^\s*(\w+)\s*(==|=|like)\s*('(?:[^']|'')*'|-?[0-9]+(?:\.[0-9]+)?)\s*$", c, re.I)
+		if m is None: continue
+		literal = m.group(3)
+		if literal[0]=="'": literal = literal[1:-1].replace("''", "'")
+		elif m.group(2).lower()=='like': continue
+		conditions.append((m.group(1).lower(), '=' if m.group(2)=='==' else m.group(2).lower(), literal))
+	return conditions
+
+
+def numeric(value):
+	# the value SQLite stores for value in a column with numeric affinity (which all logs columns have)
+	if isinstance(value, str):
+		if re.match(r'^\s*[-+]?[0-9]+\s*$', value): return int(value)
+		if re.match(r'^\s*[-+]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][-+]?[0-9]+)?\s*$', value): return float(value)
+	return value
+
+
+def prune_parser(parse, kept=None, conditions=[]):
+	# wraps a line parser so lines failing the pushed-down conditions are dropped and columns no query
+	# uses are left NULL
+	if kept is None and len(conditions)==0: return parse
+	tests = []
+	for i, op, literal in conditions:
+		if op=='like':
+			# SQLite LIKE: % and _ wildcards, case-insensitive for ASCII only
+			pattern = re.compile(''.join('.*' if ch=='%' else '.' if ch=='_' else re.escape(ch) for ch in literal), re.I | re.A | re.S)
+			tests.append((i, lambda v, pattern=pattern: v is not None and pattern.fullmatch(str(v)) is not None))
+		elif op=='>=':
+			tests.append((i, lambda v, target=literal: v is not None and v>=target))
+		elif op=='<=':
+			tests.append((i, lambda v, target=literal: v is not None and v<=target))
+		else:
+			target = numeric(literal)
+			tests.append((i, lambda v, target=target: v is not None and numeric(v)==target))
+
+	def parse_pruned(line):
+		row = parse(line)
+		if row is None: return None
+		for i, test in tests:
+			if not test(row[i]):
+				metrics['lines_filtered'] += 1 # (also counted in lines_rejected)
+				return None
+		if kept is None: return row
+		values = [None] * len(row)
+		for i in kept: values[i] = row[i]
+		return values
+
+	return parse_pruned
+
+
+def get_timestamp_index(fmt):
+	# position of the timestamp in the rows returned by make_parser(fmt)
+	if fmt=='aws-elb-classic' or fmt=='aws-elb-application': return 0
+	return 2
+
+
+def parse_lines(lines):
+	started = time.perf_counter()
+	rows = [row for row in map(parse_line, lines) if row is not None]
+	metrics['parse_seconds'] += time.perf_counter() - started
+	metrics['lines_parsed'] += len(lines)
+	metrics['lines_rejected'] += len(lines) - len(rows)
 	return rows
 
 
+def init_worker(fmt, enc, kept=None, conditions=[], fraction=1.0):
+	# (runs in each parsing process of the pool)
+	global format, encoding, parse_line, line_sample
+	format = fmt
+	encoding = enc
+	line_sample = fraction
+	random.seed() # (not the random state forked from the parent, shared by every worker)
+	parse_line = prune_parser(make_parser(fmt), kept, conditions)
+
+
+def compression(path):
+	# 'gzip', 'bz2', 'zstd' or None, from the file's magic bytes (not its name)
+	with open(path, 'rb') as f:
+		magic = f.read(4)
+	if magic[:2]==b'\x1f\x8b': return 'gzip'
+	if magic[:3]==b'BZh': return 'bz2'
+	if magic==b'\x28\xb5\x2f\xfd': return 'zstd'
+	return None
+
+
+def open_log(path, text=True):
+	# opens a log file for reading in large blocks, decompressing it on the fly if needed
+	kind = compression(path)
+	if kind=='gzip':
+		f = io.BufferedReader(gzip.open(path, 'rb'), read_block_size)
+	elif kind=='bz2':
+		f = io.BufferedReader(bz2.open(path, 'rb'), read_block_size)
+	elif kind=='zstd':
+		if zstandard is None:
+			raise ImportError('Reading .zst log files requires the zstandard package (pip install zstandard): ' + path)
+		f = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), read_size=read_block_size, read_across_frames=True, closefd=True), read_block_size)
+	else:
+		f = open(path, 'rb', buffering=read_block_size)
+	if text:
+		return io.TextIOWrapper(f, encoding=encoding)
+	return f
+
+
+def log_chunks(log_idx_rows, split=False):
+	# yields (file number, end offset, chunk) for every ~buffer_size lines of the log files, in order. A chunk
+	# is a list of raw lines or, with split=True and an uncompressed file, a (path, start, end) byte range
+	# for a worker process to read itself. Chunks are also capped in bytes, so that the chunks in flight
+	# (see parse_log_chunks()) fit in their share of the memory limit.
+	max_chunk_bytes = max(64 * 1024, memory // (8 * workers * row_expansion))
+	position = resume_state.get('position') if resume_state is not None else None
+	for n, log_idx_row in enumerate(log_idx_rows):
+		if position is not None and n<position[0]: continue # (already processed before the checkpoint)
+		path = log_idx_row[0]
+		line_bytes = max(1, int(log_idx_row[5]) // max(1, int(log_idx_row[2])))
+		chunk_bytes = max(64 * 1024, min(buffer_size * line_bytes, max_chunk_bytes))
+		compressed = compression(path) is not None
+		first, stop = (0, None) if compressed else file_range(log_idx_row)
+		if position is not None and n==position[0]: first = max(first, position[2])
+		if split and not compressed:
+			size = os.path.getsize(path)
+			stop = size if stop is None else min(stop, size)
+			for offset in range(first, stop, chunk_bytes):
+				yield n, min(offset + chunk_bytes, stop), (path, offset, min(offset + chunk_bytes, stop))
+		else:
+			offset = first
+			with open_log(path, text=False) as f:
+				if first>0:
+					f.seek(first - 1)
+					f.readline() # (a line straddling first was read before it)
+					offset = f.tell()
+				started = time.perf_counter()
+				lines = f.readlines(chunk_bytes)
+				metrics['read_seconds'] += time.perf_counter() - started
+				while len(lines)>0:
+					offset += sum(map(len, lines))
+					yield n, offset, lines
+					if stop is not None and offset>=stop: break
+					started = time.perf_counter()
+					lines = f.readlines(chunk_bytes)
+					metrics['read_seconds'] += time.perf_counter() - started
+
+
+def chunk_size(chunk):
+	if isinstance(chunk, tuple): return chunk[2] - chunk[1]
+	return sum(map(len, chunk))
+
+
+def parse_chunk(chunk):
+	if isinstance(chunk, tuple):
+		path, start, end = chunk
+		started = time.perf_counter()
+		with open(path, 'rb') as f:
+			if start>0:
+				f.seek(start - 1)
+				f.readline() # (a line straddling start belongs to the previous range)
+			lines = f.readlines(end - f.tell()) if f.tell()<end else []
+		metrics['read_seconds'] += time.perf_counter() - started
+	else:
+		lines = chunk
+	metrics['bytes_read'] += sum(map(len, lines))
+	if line_sample<1.0:
+		# (sample_mode 'lines') skip decoding and parsing the lines left out of the sample
+		n_lines = len(lines)
+		lines = [line for line in lines if random.random()<line_sample]
+		metrics['lines_unsampled'] += n_lines - len(lines)
+	lines = b''.join(lines).decode(encoding).split('\n')
+	if len(lines)>0 and lines[-1]=='': lines.pop()
+	return parse_lines(lines)
+
+
+def parse_chunk_in_worker(chunk):
+	# (runs in a parsing process) returns the rows, and the metrics counted parsing them
+	rows = parse_chunk(chunk)
+	counted = dict(metrics)
+	metrics.clear()
+	return rows, counted
+
+
+def parse_log_chunks(log_idx_rows):
+	# yields (file number, end offset, rows) for each chunk of the log files, in order; with workers>1 the
+	# chunks are parsed by a process pool, with at most 2*workers of them in flight (counted in pending_bytes),
+	# and (but for one) no more than their rows would fit in a quarter of memory, so that read-ahead alone
+	# never fills memory and makes historical.py run the queries after every chunk
+	global pending_bytes
+	if workers<=1:
+		for n, offset, chunk in log_chunks(log_idx_rows):
+			yield n, offset, parse_chunk(chunk)
+		return
+	with multiprocessing.Pool(workers, init_worker, (format, encoding, kept_columns, pushdown, line_sample)) as pool:
+		pending = collections.deque()
+		for n, offset, chunk in log_chunks(log_idx_rows, split=True):
+			size = chunk_size(chunk)
+			while len(pending)>=2 * workers or (len(pending)>0 and (pending_bytes + size) * row_expansion > memory / 4):
+				done_n, done_offset, done_size, result = pending.popleft()
+				rows, counted = result.get()
+				metrics.update(counted)
+				pending_bytes -= done_size
+				yield done_n, done_offset, rows
+			pending_bytes += size
+			pending.append((n, offset, size, pool.apply_async(parse_chunk_in_worker, (chunk,))))
+		while pending:
+			n, offset, size, result = pending.popleft()
+			rows, counted = result.get()
+			metrics.update(counted)
+			pending_bytes -= size
+			yield n, offset, rows
+
+
+def memory_estimate():
+	# bytes used by the database (plus the indexes build_indexes() will add, and its copies while the queries
+	# run) plus (an estimate for) log lines that are read but not yet inserted
+	return get_db_stat('PRAGMA page_size') * get_db_stat('PRAGMA page_count') * index_overhead * snapshot_copies('static') + pending_bytes * row_expansion
+
+
+def insert_rows(rows, weight=1):
+	# weight is the sample_weight of the rows, if they have one (None: the rows have it already, like rows held back)
+	global connection, n_late
+	started = time.perf_counter()
+	if compact: rows = encode_rows(rows)
+	weight = '?' if weight is None else repr(weight)
+	cur = connection.cursor()
+	if partition<=0:
+		cur.executemany(insert_query.format(table=data_table, weight=weight), rows)
+		connection.commit()
+		update_db_stats(None, rows)
+		metrics['rows_ingested'] += len(rows)
+		metrics['insert_seconds'] += time.perf_counter() - started
+		return
+
+	# route rows to the partition for their time bucket (rows arrive roughly in time order)
+	for bucket, bucket_rows in itertools.groupby(rows, lambda row: row[timestamp_index]//partition):
+		bucket_rows = list(bucket_rows)
+		key = partition_key(bucket)
+		if key is None and (evicted_before is None or bucket>=evicted_before):
+			create_partition(bucket)
+			key = partition_key(bucket)
+		if key is None:
+			n_late += len(bucket_rows) # its partition was already evicted
+			continue
+		cur.executemany(insert_query.format(table=partitions[key], weight=weight), bucket_rows)
+		update_db_stats(key, bucket_rows)
+		metrics['rows_ingested'] += len(bucket_rows)
+	connection.commit()
+	metrics['insert_seconds'] += time.perf_counter() - started
+
+
+def update_db_stats(bucket, rows):
+	# keeps the row count and timestamp range of what's stored, so they needn't be queried
+	global changed_since
+	if len(rows)==0: return
+	timestamps = [row[timestamp_index] for row in rows]
+	if changed_since is None or min(timestamps)<changed_since: changed_since = min(timestamps)
+	stats = db_stats.get(bucket)
+	if stats is None:
+		db_stats[bucket] = [len(rows), min(timestamps), max(timestamps)]
+	else:
+		stats[0] += len(rows)
+		stats[1] = min(stats[1], min(timestamps))
+		stats[2] = max(stats[2], max(timestamps))
+
+
+def recount_db_stats():
+	# (after rows are deleted by timestamp rather than by dropping partitions) one scan to recount them
+	db_stats.clear()
+	n_rows, min_ts, max_ts = connection.execute("SELECT COUNT(*), MIN(timestamp), MAX(timestamp) FROM " + data_table).fetchone()
+	if n_rows>0: db_stats[None] = [n_rows, min_ts, max_ts]
+
+
 def ingest_logs():
-	global connection, buffer, format, fields, buffer_size
+	global buffer
 	#print('Ingesting batch of '+str(buffer_size)+' lines...')
-	log_values = []
-	for log in buffer:
-		# Note: for Python 2.7 compatibility, use ur"" to prefix the regex and u"" to prefix the test string and substitution.
-		if format=='aws-elb-classic':
-			# REFERENCE: https://docs.aws.amazon.com/athena/latest/ug/application-load-balancer-logs.html#create-alb-table
-			regex = r'([^ ]*) ([^ ]*) ([^ ]*):([0-9]*) ([^ ]*)[:-]([0-9]*) ([-.0-9]*) ([-.0-9]*) ([-.0-9]*) (|[-0-9]*) (-|[-0-9]*) ([-0-9]*) ([-0-9]*) "([^ ]*) ([^ ]*) (- |[^ ]*)" ("[^\"]*") ([A-Z0-9-]+) ([A-Za-z0-9.-]*)$'
-		elif format=='aws-elb-application':
-			regex = r'([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*):([0-9]*) ([^ ]*)[:-]([0-9]*) ([-.0-9]*) ([-.0-9]*) ([-.0-9]*) (|[-0-9]*) (-|[-0-9]*) ([-0-9]*) ([-0-9]*) \"([^ ]*) ([^ ]*) (- |[^ ]*)\" \"([^\"]*)\" ([A-Z0-9-]+) ([A-Za-z0-9.-]*) ([^ ]*) \"([^\"]*)\" \"([^\"]*)\" \"([^\"]*)\" ([-.0-9]*) ([^ ]*) \"([^\"]*)\" \"([^\"]*)\" \"([^ ]*)\" \"([^\s]+?)\" \"([^\s]+)\" \"([^ ]*)\" \"([^ ]*)\"'
-			#([^ ]*) ([^ ]*) ([^ ]*) ([^ ]*):([0-9]*) ([^ ]*)[:-]([0-9]*) ([-.0-9]*) ([-.0-9]*) ([-.0-9]*) (|[-0-9]*) (-|[-0-9]*) ([-0-9]*) ([-0-9]*) "([^ ]*) ([^ ]*) (- |[^ ]*)" ("[^\"]*") ([A-Z0-9-]+) ([A-Za-z0-9.-]*)$'
-		elif format=='ncsa-common':
-			regex = '([(\d\.)]+) - (.*?) \[(.*?)\] "(.*?) (.*?) (.*?)" (\d+) (\d+)'
-		elif format=='ncsa-combined':
-			regex = '([(\d\.)]+) - (.*?) \[(.*?)\] "(.*?) (.*?) (.*?)" (\d+) (\d+) "(.*?)" "(.*?)"'
-
-		matches = re.search(regex, log.strip())
-		if matches:
-			values = []
-			for i, field in enumerate(fields):
-				if field=='timestamp' and (format=='ncsa-common' or format=='ncsa-combined'):
-					values.append(datetime.timestamp(parse(matches.group(i+1).replace(':',' ',1))))
-				elif format=='aws-elb-application' and field=='type':
-					continue
-				else:
-					values.append(matches.group(i+1))
-			log_values.append(values)
-	cur = connection.cursor()
+	insert_rows(parse_lines(buffer))
 
-	if format=='aws-elb-classic' or format=='aws-elb-application':
-		cur.executemany("""INSERT INTO logs (
-timestamp, elb_name, request_ip, request_port, backend_ip, backend_port,
-request_processing_time, backend_processing_time, client_response_time,
-request_status_code, backend_status_code, received_bytes, sent_bytes,
-request_verb, request_url, request_protocol, user_agent, ssl_cipher, ssl_protocol
-) VALUES ( strftime('%s', ?), ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ? )
-""", log_values)
-	elif format=='ncsa-common':
-		cur.executemany("""INSERT INTO logs (
-request_ip, auth_user, timestamp, request_verb, request_url, request_protocol, request_status_code,
-sent_bytes) VALUES ( ?, ?, ?, ?, ?, ?, ?, ? )
-""", log_values)
-	elif format=='ncsa-combined':
-		cur.executemany("""INSERT INTO logs (
-request_ip, auth_user, timestamp, request_verb, request_url, request_protocol, request_status_code,
-sent_bytes, referrer, user_agent) VALUES ( ?, ?, ?, ?, ?, ?, ?, ?, ?, ? )
-""", log_values)
 
-	connection.commit()
+def query_connection():
+	# (runs in a query thread) deserialize the current snapshot, once per thread per batch
+	if getattr(query_local, 'snapshot_id', None)!=snapshot_id:
+		release_query_connection()
+		conn = sqlite3.connect(':memory:', check_same_thread=False)
+		conn.deserialize(snapshot)
+		register_functions(conn)
+		query_local.connection = conn
+		query_local.snapshot_id = snapshot_id
+	return query_local.connection
 
 
-def run_queries(mode='live', params=()):
-	global connection, queries, output
-	#print('Running queries...')
-	for i, q in enumerate(queries):
-		cur = connection.cursor()
-		# prevent accidentally dumping tons of data to console!
+def snapshot_connection():
+	# (live.py, with one query worker) a copy of the database for the queries to run over, made with the
+	# backup API: one copy, where serialize() and deserialize() make two
+	conn = sqlite3.connect(':memory:', check_same_thread=False)
+	connection.backup(conn)
+	register_functions(conn)
+	return conn
+
+
+def snapshot_copies(mode='live'):
+	# how many copies of the database are in memory while the queries run: the database, and the snapshot
+	# they run over (with query-workers, the serialized snapshot plus each worker's copy of it; historical.py
+	# queries the database itself otherwise)
+	if not hasattr(sqlite3.Connection, 'serialize'): return 1
+	if query_workers<=1: return 2 if mode=='live' else 1
+	return query_workers + 2
+
+
+def release_query_connection(barrier=None):
+	# (runs in a query thread) free this thread's copy of the database; the barrier makes sure
+	# every thread in the pool picks up exactly one release task
+	if barrier is not None: barrier.wait()
+	if getattr(query_local, 'connection', None) is not None:
+		query_local.connection.close()
+		query_local.connection = None
+		query_local.snapshot_id = None
+
+
+def run_live_query(i, mode='live', params=(), conn=None):
+	# (live.py) a query that fails (bad SQL, an error in a function, a full disk) is reported and counted,
+	# and the other queries still run; live.py tries it again next period
+	try:
+		run_query(i, mode, params, conn)
+	except Exception as e:
+		print('Query '+str(i)+' failed: '+str(e))
+		with metrics_lock:
+			metrics['query_errors'] += 1
+			query_metrics[i]['errors'] += 1
+
+
+def run_query(i, mode='live', params=(), conn=None):
+	global queries, output
+	if conn is None: conn = query_connection()
+	if mode=='live' and i<len(query_options) and 'incremental' in query_options[i]:
+		return run_incremental_query(i, conn)
+	start_sketch_run(i, mode) # (so sketch aggregates know which query and run they belong to)
+	started = time.perf_counter()
+	cur = conn.cursor()
+	# prevent accidentally dumping tons of data to console!
+	try:
 		if len(params)>0:
-			cur.execute(q, params)
+			cur.execute(query_sql(i, mode), params)
+		else:
+			cur.execute(query_sql(i, mode))
+		query_seconds = time.perf_counter() - started
+		output_seconds = 0
+		columns = [d[0] for d in cur.description]
+		out = None
+		if not (merge and mode=='static'): out = open_output(i, mode)
+		# results are streamed to the output a block of rows at a time, so they're never all in memory
+		n_rows = 0
+		while True:
+			started = time.perf_counter()
+			rows = cur.fetchmany(fetch_rows)
+			query_seconds += time.perf_counter() - started
+			if len(rows)==0: break
+			n_rows += len(rows)
+			started = time.perf_counter()
+			if out is None: stage_rows(i, columns, rows)
+			else: out.write(columns, rows)
+			output_seconds += time.perf_counter() - started
+	except sqlite3.Error as e:
+		raise sketch_failed(e)
+	end_sketch_run(i, mode)
+	started = time.perf_counter()
+	if out is not None:
+		if mode=='live': out.close(columns)
+		else: out.flush()
+	output_seconds += time.perf_counter() - started
+	with metrics_lock:
+		query_metrics[i]['seconds'] += query_seconds
+		query_metrics[i]['rows'] += n_rows
+		query_metrics[i]['runs'] += 1
+		metrics['output_seconds'] += output_seconds
+
+
+def output_path(i):
+	return output + 'query' + str(i) + '.' + output_format
+
+
+def open_output(i, mode='live'):
+	# the writer for query i's output: in live mode a new one, replacing the output of the last period, and
+	# in static mode the one kept open for the whole run (appended to, like queryN.csv always was)
+	if mode=='static' and i in outputs: return outputs[i]
+	if output_format=='csv': out = CsvOutput(output_path(i), append=(mode=='static'))
+	else: out = ArrowOutput(output_path(i), output_format)
+	if mode=='static': outputs[i] = out
+	return out
+
+
+def close_outputs():
+	# (historical.py, after the last batch) Parquet and Arrow files are only complete once closed
+	for i in sorted(outputs):
+		outputs.pop(i).close()
+
+
+class CsvOutput:
+	# queryN.csv, untyped
+	def __init__(self, path, append=False):
+		self.file = open(path, 'a' if append else 'w')
+		self.writer = csv.writer(self.file)
+
+	def write(self, columns, rows):
+		self.writer.writerows(rows)
+
+	def flush(self):
+		self.file.flush()
+
+	def close(self, columns=[]):
+		self.file.close()
+
+
+class ArrowOutput:
+	# queryN.parquet or queryN.arrow (Arrow IPC file), zstd-compressed, with column types taken from the first
+	# rows written (and widened if later rows don't fit them). Every write is a row group (Parquet) or record
+	# batch (Arrow); the file is only complete once closed.
+	def __init__(self, path, kind):
+		self.path = path
+		self.kind = kind
+		self.types = None # each column's value_type() so far
+		self.schema = None
+		self.writer = None
+
+	def open_writer(self):
+		if self.kind=='parquet':
+			self.writer = pyarrow.parquet.ParquetWriter(self.path, self.schema, compression='zstd')
 		else:
-			cur.execute(q)
-		rows = cur.fetchall()
-		#print(rows[0:3])
-		if mode=='live': flag = 'w'
-		else: flag = 'a'
-		with open(output + 'query' + str(i) + '.csv', flag) as write_obj:
+			self.writer = pyarrow.ipc.new_file(self.path, self.schema, options=pyarrow.ipc.IpcWriteOptions(compression='zstd'))
+
+	def write(self, columns, rows):
+		types = [value_type([row[j] for row in rows]) for j in range(len(columns))]
+		if self.types is None:
+			self.types = types
+			self.schema = arrow_schema(columns, types)
+		elif any(widen_type(a, b)!=a for a, b in zip(self.types, types)):
+			self.types = [widen_type(a, b) for a, b in zip(self.types, types)]
+			self.widen(arrow_schema(columns, self.types))
+		if self.writer is None: self.open_writer()
+		if len(rows)>0: self.writer.write_table(arrow_table(self.schema, rows))
+
+	def widen(self, schema):
+		# these rows have values the columns' types can't hold (like a float in an integer column): rewrite
+		# what's written so far with the wider types, rather than lose the values
+		with metrics_lock: metrics['output_schemas_widened'] += 1
+		self.schema = schema
+		if self.writer is None: return
+		self.writer.close()
+		old = self.path + '.tmp'
+		os.replace(self.path, old)
+		self.open_writer()
+		with pyarrow.OSFile(old, 'rb') as f:
+			if self.kind=='parquet':
+				batches = pyarrow.parquet.ParquetFile(f).iter_batches()
+			else:
+				reader = pyarrow.ipc.open_file(f)
+				batches = (reader.get_batch(k) for k in range(reader.num_record_batches))
+			for batch in batches:
+				arrays = [cast_array(batch.column(j), field.type) for j, field in enumerate(schema)]
+				self.writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+		os.remove(old)
+
+	def flush(self):
+		pass
+
+	def close(self, columns=[]):
+		if self.writer is None: self.write(columns, []) # (no rows: a file with just the columns)
+		self.writer.close()
+
+
+def value_type(values):
+	# the Arrow type for a column's values: integer, float, bytes or (for anything else, or mixed types)
+	# string; None if they're all empty
+	types = set(type(v) for v in values if v is not None)
+	if len(types)==0: return None
+	if types<={int}: return pyarrow.int64()
+	if types<={int, float}: return pyarrow.float64()
+	if types<={bytes}: return pyarrow.binary()
+	return pyarrow.string()
+
+
+def widen_type(a, b):
+	# a type for the values of both types a and b: integer and float make float, other mixes string
+	if a is None or a==b: return b if a is None else a
+	if b is None: return a
+	if a in [pyarrow.int64(), pyarrow.float64()] and b in [pyarrow.int64(), pyarrow.float64()]: return pyarrow.float64()
+	return pyarrow.string()
+
+
+def arrow_schema(columns, types):
+	# (columns without values yet are strings until they get some)
+	fields = []
+	names = set()
+	for name, kind in zip(columns, types):
+		while name in names: name += '_' # (like two COUNT(*) columns)
+		names.add(name)
+		fields.append(pyarrow.field(name, kind if kind is not None else pyarrow.string()))
+	return pyarrow.schema(fields)
+
+
+def cast_array(array, type):
+	if array.type==type: return array
+	try:
+		return array.cast(type, safe=False)
+	except pyarrow.ArrowException:
+		# (like bytes that aren't valid text)
+		return pyarrow.array([convert_value(v, type) for v in array.to_pylist()], type=type)
+
+
+def arrow_table(schema, rows):
+	arrays = []
+	for j, field in enumerate(schema):
+		values = [row[j] for row in rows]
+		try:
+			arrays.append(pyarrow.array(values, type=field.type))
+		except (pyarrow.ArrowException, TypeError, ValueError, OverflowError):
+			# a value that doesn't fit the column's type (SQLite columns aren't typed): converted, or left empty
+			values = [convert_value(v, field.type) for v in values]
+			arrays.append(pyarrow.array(values, type=field.type))
+	return pyarrow.Table.from_arrays(arrays, schema=schema)
+
+
+def convert_value(value, type):
+	if value is None: return None
+	try:
+		if type==pyarrow.string(): return value.decode(encoding, errors='replace') if isinstance(value, bytes) else str(value)
+		if type==pyarrow.int64(): return int(value)
+		if type==pyarrow.float64(): return float(value)
+		return bytes(str(value), encoding) if not isinstance(value, bytes) else value
+	except (TypeError, ValueError, OverflowError):
+		with metrics_lock: metrics['output_values_dropped'] += 1
+		return None
+
+
+def mark_changes(final=False):
+	# (with the snapshot the queries run on; under db_lock in live.py) note what's changed since the last run
+	global changed_since, changed_from, snapshot_range, snapshot_partitions, sketch_upto
+	changed_from = changed_since
+	changed_since = None
+	snapshot_range = db_range()[1:]
+	snapshot_partitions = dict(partitions)
+	# (sketches take the newest second too once the input has ended)
+	if snapshot_range[1] is not None: sketch_upto = int(snapshot_range[1]) + (1 if final else 0)
+
+
+def logs_select(first, stop):
+	# SELECT of the logs rows with first <= timestamp < stop, reading only the partitions that can hold them
+	if partition>0:
+		keys = sorted(snapshot_partitions)
+		tables = [snapshot_partitions[b] for j, b in enumerate(keys) if b<=(stop-1)//partition and (j+1==len(keys) or keys[j+1]>first//partition)]
+		source = " UNION ALL ".join(["SELECT * FROM main." + table for table in tables] or ["SELECT * FROM main.logs_empty"])
+	else:
+		source = "SELECT * FROM main." + data_table
+	source = "(SELECT * FROM (" + source + ") WHERE timestamp>=" + str(first) + " AND timestamp<" + str(stop) + ")"
+	if compact: return compact_select(source)
+	return "SELECT * FROM " + source
+
+
+def run_incremental_query(i, conn):
+	# (live mode, #incremental: queries) re-evaluate the query only over the time buckets with rows inserted
+	# since the last run, each bucket on its own (through a temporary logs view that shadows the real one),
+	# keep the results per bucket, and rewrite queryN.csv from the first changed bucket on
+	size = query_options[i]['incremental']
+	results = incremental_results.setdefault(i, {})
+	started = time.perf_counter()
+	n_rows = 0
+	rewrite_from = None
+	min_ts, max_ts = snapshot_range
+	changed = changed_from
+	mark = sketch_marks.get(i)
+	if mark is not None and sketch_upto is not None and mark<sketch_upto and query_sql(i)!=queries[i] and (changed is None or mark<changed):
+		changed = mark # (and the bucket of the newest second its sketches left for this run)
+	if changed is not None and max_ts is not None:
+		rewrite_from = int(changed) // size * size
+		cur = conn.cursor()
+		try:
+			for bucket in range(max(rewrite_from, int(min_ts) // size * size), int(max_ts) + 1, size):
+				cur.execute("DROP VIEW IF EXISTS temp.logs")
+				cur.execute("CREATE TEMP VIEW logs AS " + logs_select(bucket, bucket + size))
+				if cur.execute("SELECT 1 FROM temp.logs LIMIT 1").fetchone() is None:
+					results.pop(bucket, None)
+					continue
+				start_sketch_run(i, bucket=bucket)
+				try:
+					results[bucket] = cur.execute(query_sql(i)).fetchall()
+				except sqlite3.Error as e:
+					raise sketch_failed(e)
+				result_columns[i] = [d[0] for d in cur.description]
+				n_rows += len(results[bucket])
+		finally:
+			cur.execute("DROP VIEW IF EXISTS temp.logs")
+		end_sketch_run(i)
+	# buckets whose rows have all been evicted leave the output too
+	if min_ts is not None:
+		for bucket in [b for b in results if b + size<=min_ts]:
+			del results[bucket]
+			drop_sketches(i, bucket)
+			rewrite_from = -math.inf
+	query_seconds = time.perf_counter() - started
+
+	started = time.perf_counter()
+	path = output_path(i)
+	offsets = incremental_offsets.get(i)
+	if offsets is None or not os.path.exists(path): rewrite_from = -math.inf # (first run, or after a restart)
+	if rewrite_from is not None and output_format!='csv':
+		# (Parquet and Arrow files can't be truncated: rewritten whole)
+		out = open_output(i)
+		for bucket in sorted(results):
+			if len(results[bucket])>0: out.write(result_columns[i], results[bucket])
+		out.close(result_columns.get(i, []))
+		incremental_offsets[i] = []
+	elif rewrite_from is not None:
+		kept = [(b, offset) for b, offset in offsets or [] if b<rewrite_from]
+		stale = [offset for b, offset in offsets or [] if b>=rewrite_from]
+		rewrite = [b for b in sorted(results) if b>=rewrite_from]
+		with open(path, 'r+' if len(kept)>0 else 'w') as write_obj:
+			if len(kept)>0:
+				if len(stale)>0: write_obj.seek(stale[0])
+				else: write_obj.seek(0, os.SEEK_END)
+				write_obj.truncate()
 			csv_writer = csv.writer(write_obj)
-			for row in rows:
-				csv_writer.writerow(row)
+			for bucket in rewrite:
+				kept.append((bucket, write_obj.tell()))
+				for row in results[bucket]:
+					csv_writer.writerow(row)
+		incremental_offsets[i] = kept
+	with metrics_lock:
+		query_metrics[i]['seconds'] += query_seconds
+		query_metrics[i]['rows'] += n_rows
+		query_metrics[i]['runs'] += 1
+		metrics['output_seconds'] += time.perf_counter() - started
+
+
+def run_queries(mode='live', params=(), data=None):
+	# data, if given, is a serialized copy of the database to run the queries over instead of
+	# connection (so that live.py can keep ingesting while queries run)
+	global connection, queries, query_pool, snapshot, snapshot_id
+	#print('Running queries...')
+	if query_workers<=1:
+		conn = connection
+		if isinstance(data, sqlite3.Connection):
+			conn = data # (a snapshot_connection())
+		elif data is not None:
+			conn = sqlite3.connect(':memory:')
+			conn.deserialize(data)
+			register_functions(conn)
+		for i in range(len(queries)):
+			run = run_query if mode=='static' else run_live_query
+			run(i, mode, params, conn)
+		if conn is not connection and conn is not data: conn.close() # (a snapshot_connection() is the caller's to close)
+		if len(sketch_states)>0: write_sketches()
+		return
+
+	# run the queries in parallel: each query thread gets a private copy of the batch (SQLite
+	# releases the GIL while a query runs), and each query writes its own output file
+	if query_pool is None: query_pool = ThreadPoolExecutor(query_workers)
+	snapshot = data if data is not None else connection.serialize()
+	snapshot_id += 1
+	try:
+		futures = [query_pool.submit(run_query if mode=='static' else run_live_query, i, mode, params) for i in range(len(queries))]
+		for f in futures: f.result()
+	finally:
+		barrier = threading.Barrier(query_workers)
+		for f in [query_pool.submit(release_query_connection, barrier) for i in range(query_workers)]: f.result()
+		snapshot = None
+	if len(sketch_states)>0: write_sketches()
+
+
+def select_list(query):
+	# the top-level output expressions of a query (of its last top-level SELECT, after any WITH)
+	depth = 0
+	quote = None
+	expressions = None
+	start = 0
+	i = 0
+	lower = query.lower()
+	while i<len(query):
+		ch = query[i]
+		if quote is not None:
+			if ch==quote: quote = None
+		elif ch in '\'"`[':
+			quote = ']' if ch=='[' else ch
+		elif ch=='(':
+			depth += 1
+		elif ch==')':
+			depth -= 1
+		elif depth==0 and re.match(r'\bselect\b', lower[i:i+7]) and (i==0 or not (lower[i-1].isalnum() or lower[i-1]=='_')):
+			expressions = []
+			i += 6
+			start = i
+		elif depth==0 and expressions is not None and ch==',':
+			expressions.append(query[start:i])
+			start = i + 1
+		elif depth==0 and expressions is not None and re.match(r'\b(from|where|group|order|limit|window)\b', lower[i:i+7]) and not (lower[i-1].isalnum() or lower[i-1]=='_'):
+			expressions.append(query[start:i])
+			return [re.sub(r'^\s*(distinct|all)\s+', '', e, flags=re.I).strip() for e in expressions]
+		i += 1
+	if expressions is None: return []
+	expressions.append(query[start:])
+	return [re.sub(r'^\s*(distinct|all)\s+', '', e, flags=re.I).strip() for e in expressions]
+
+
+def order_by(query):
+	# (with merge) the top-level ORDER BY of a query as terms over the positions of its output columns, so it
+	# can be applied again to the merged rows: [] if it has none, None if a term isn't an output column (by
+	# position, by name or as the same expression)
+	depth = 0
+	quote = None
+	terms = None
+	start = 0
+	end = len(query)
+	lower = query.lower()
+	for i, ch in enumerate(lower):
+		if quote is not None:
+			if ch==quote: quote = None
+			continue
+		elif ch in '\'"`[':
+			quote = ']' if ch=='[' else ch
+		elif ch=='(':
+			depth += 1
+		elif ch==')':
+			depth -= 1
+		elif depth==0 and (i==0 or not (lower[i-1].isalnum() or lower[i-1]=='_')):
+			if re.match(r'select\b', lower[i:i+7]):
+				terms = None
+			elif terms is None and re.match(r'order\s+by\b', lower[i:i+20]):
+				terms = []
+				start = i + re.match(r'order\s+by\b', lower[i:i+20]).end()
+			elif terms is not None and re.match(r'limit\b', lower[i:i+6]):
+				end = i
+				break
+		if depth==0 and terms is not None and i>=start:
+			if ch==';':
+				end = i
+				break
+			if ch==',':
+				terms.append(query[start:i])
+				start = i + 1
+	if terms is None: return []
+	terms.append(query[start:end])
+	names = []
+	for e in select_list(query):
+		m = re.match(r'^(.*?)(?:\s+as)?\s+(["`\[]?\w+["`\]]?)$', e, re.I | re.S)
+		if m is None or re.match(r'^(as|end|asc|desc|and|or|not|is|null)$', m.group(2), re.I) or not re.search(r'[\w)\]"`\']$', m.group(1)):
+			names.append((re.sub(r'\s+', '', e.lower()), None))
+		else:
+			names.append((re.sub(r'\s+', '', m.group(1).lower()), m.group(2).strip('"`[]').lower()))
+	order = []
+	for term in terms:
+		m = re.match(r'^\s*(.*?)((?:\s+collate\s+\w+)?(?:\s+(?:asc|desc))?(?:\s+nulls\s+(?:first|last))?)\s*$', term, re.I | re.S)
+		expression = re.sub(r'\s+', '', m.group(1).lower())
+		if expression.isdigit() and 1<=int(expression)<=len(names):
+			j = int(expression) - 1
+		else:
+			matches = [j for j, (e, name) in enumerate(names) if expression.strip('"`[]')==name or expression==e]
+			if len(matches)==0: return None
+			j = matches[0]
+		order.append(str(j + 1) + m.group(2))
+	return order
+
+
+def top_level_select(query):
+	# the text of the last top-level SELECT of a query (after any WITH), lowercase, leaving out what's in
+	# parentheses or quotes
+	depth = 0
+	quote = None
+	text = []
+	lower = query.lower()
+	for i, ch in enumerate(lower):
+		if quote is not None:
+			if ch==quote: quote = None
+		elif ch in '\'"`[':
+			quote = ']' if ch=='[' else ch
+		elif ch=='(':
+			depth += 1
+		elif ch==')':
+			depth -= 1
+		elif depth==0:
+			if lower[i:i+6]=='select' and (i==0 or not (lower[i-1].isalnum() or lower[i-1]=='_')): text = []
+			text.append(ch)
+	return ''.join(text)
+
+
+def infer_combiners(query):
+	# how to merge each output column of query across batches, from its select list: COUNT/SUM
+	# are summed, MIN/MAX kept, AVG weighted by a COUNT of the same expression (which, unlike COUNT(*),
+	# leaves out the same NULLs), approx_*() (already merged over all batches) taken from the last batch,
+	# and everything else is a group key. Returns None if some column is an aggregate it can't merge, or
+	# if the batches' results aren't whole groups: HAVING and LIMIT filter each batch before the merge,
+	# and DISTINCT and window functions work on a batch's rows.
+	if re.search(r'^select\s+distinct\b|\b(having|limit|over|window)\b', top_level_select(query)): return None
+	aggregate = re.compile(r'\b(count|sum|total|min|max|avg|group_concat|approx_\w+)\s*\(', re.I)
+	combiners = []
+	arguments = []
+	for e in select_list(query):
+		m = re.match(r'(count|sum|total|min|max|avg|approx_\w+)\s*\(\s*(distinct\b)?', e, re.I)
+		if m is None:
+			if aggregate.search(e): return None
+			combiners.append('key')
+			arguments.append(None)
+			continue
+		depth = 0
+		for j in range(m.end(1), len(e)):
+			if e[j]=='(': depth += 1
+			elif e[j]==')': depth -= 1
+			if depth==0: break
+		rest = e[j+1:].strip()
+		if rest!='' and not re.match(r'^(as\s+)?["`\[]?\w+["`\]]?$', rest, re.I): return None
+		function = m.group(1).lower()
+		if m.group(2) is not None and function!='min' and function!='max': return None
+		arguments.append(re.sub(r'\s+', '', e[m.end(1):j+1].lower()))
+		if function in ['count', 'sum', 'total']: combiners.append('count' if function=='count' else 'sum')
+		elif function in ['min', 'max']: combiners.append(function)
+		elif function=='avg': combiners.append('avg')
+		else: combiners.append('last')
+	for j, c in enumerate(combiners):
+		if c!='avg': continue
+		counts = [k for k, d in enumerate(combiners) if d=='count' and arguments[k]==arguments[j]]
+		if len(counts)==0: return None
+		combiners[j] = 'avg@' + str(counts[0])
+	return ['sum' if c=='count' else c for c in combiners]
+
+
+def start_staging():
+	# (with merge) per-batch query results go to staging.sqlite in the output directory until merge_results()
+	global staging
+	path = output + 'staging.sqlite'
+	if os.path.exists(path) and resume_state is None: os.remove(path)
+	staging = sqlite3.connect(path, check_same_thread=False)
+	if checkpoint_file=='':
+		staging.execute('PRAGMA synchronous = OFF')
+		staging.execute('PRAGMA journal_mode = OFF')
+	if resume_state is not None:
+		# drop what was staged after the checkpoint (it's staged again)
+		for table, n_rows in resume_state['staged'].items():
+			staging.execute('DELETE FROM ' + table + ' WHERE rowid>?', (n_rows,))
+		for (table,) in staging.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall():
+			if table not in resume_state['staged']: staging.execute('DROP TABLE ' + table)
+		staging.commit()
+
+
+def stage_rows(i, names, rows):
+	# (may run in a query thread) names are the query's output column names, kept for the merged output
+	global staging
+	with staging_lock:
+		n_columns = len(names)
+		columns = ['c' + str(j) for j in range(n_columns)]
+		staging.execute('CREATE TABLE IF NOT EXISTS query' + str(i) + ' (' + ', '.join(columns) + ')')
+		staging.execute('CREATE TABLE IF NOT EXISTS staged_columns (query int primary key, names string)')
+		staging.execute('INSERT OR IGNORE INTO staged_columns VALUES (?, ?)', (i, json.dumps(names)))
+		staging.executemany('INSERT INTO query' + str(i) + ' VALUES (' + ', '.join(['?'] * n_columns) + ')', rows)
+		staging.commit()
+
+
+class MergeLast:
+	# the value from the latest staged row of a group
+	def __init__(self):
+		self.rowid = None
+		self.value = None
+
+	def step(self, rowid, value):
+		if self.rowid is None or rowid>self.rowid:
+			self.rowid = rowid
+			self.value = value
+
+	def finalize(self):
+		return self.value
+
+
+def merge_results():
+	# (with merge) re-aggregate each query's staged batch results by its key columns into queryN.csv (or .parquet, .arrow)
+	global staging
+	staging.create_aggregate('merge_last', 2, MergeLast)
+	cur = staging.cursor()
+	for i in range(len(queries)):
+		if get_staged_columns(i) is None:
+			open_output(i).close()
+			continue
+		n_columns = get_staged_columns(i)
+		combiners = query_options[i]['merge']
+		order = query_options[i]['order']
+		if all(c=='key' for c in combiners) and not re.search(r'^select\s+distinct\b|\bgroup\s+by\b', top_level_select(queries[i])):
+			# nothing to aggregate (like a filtering query): keep every row
+			sql = 'SELECT * FROM query' + str(i) + ' ORDER BY ' + ', '.join(order + ['rowid'])
+		else:
+			# (with only keys, like SELECT DISTINCT or a GROUP BY without aggregates, each group is kept once)
+			if len(combiners)!=n_columns:
+				print('Query '+str(i)+' has '+str(n_columns)+' output columns but '+str(len(combiners))+' "merge" combiners. Declare them with a "#merge:" line.')
+				exit()
+			select = []
+			keys = []
+			for j, c in enumerate(combiners):
+				column = 'c' + str(j)
+				if c=='key':
+					select.append(column)
+					keys.append(column)
+				elif c=='last': select.append('merge_last(rowid, ' + column + ')')
+				elif c[:4]=='avg@': select.append('SUM(' + column + ' * c' + c[4:] + ') / SUM(c' + c[4:] + ')')
+				else: select.append(c.upper() + '(' + column + ')')
+			sql = 'SELECT ' + ', '.join(select) + ' FROM query' + str(i)
+			if len(keys)>0: sql += ' GROUP BY ' + ', '.join(keys) + ' ORDER BY ' + ', '.join(order + ['MIN(rowid)'])
+		names = json.loads(staging.execute('SELECT names FROM staged_columns WHERE query=?', (i,)).fetchone()[0])
+		cur.execute(sql)
+		out = open_output(i) # (a new file, like in live mode)
+		rows = cur.fetchmany(fetch_rows)
+		while len(rows)>0:
+			out.write(names, rows)
+			rows = cur.fetchmany(fetch_rows)
+		out.close(names)
+	staging.close()
+	staging = None
+	os.remove(output + 'staging.sqlite')
+
+
+def get_staged_columns(i):
+	rows = staging.execute('PRAGMA table_info(query' + str(i) + ')').fetchall()
+	if len(rows)==0: return None
+	return len(rows)
+
+
+def sketch_calls(query, live=False):
+	# query with each approx_*() call rewritten to its sketch_*() version, which is also passed the call's
+	# position in the query (so that two calls keep separate states) and, in live.py, the row's timestamp
+	# (so that each row is merged only once, see sketch_call())
+	quote = None
+	calls = 0
+	text = []
+	i = 0
+	while i<len(query):
+		ch = query[i]
+		if quote is not None:
+			if ch==quote: quote = None
+		elif ch in '\'"`[':
+			quote = ']' if ch=='[' else ch
+		elif i==0 or not (query[i-1].isalnum() or query[i-1]=='_'):
+			m = re.match(r'approx_(distinct|topk|quantile)\s*\(', query[i:], re.I)
+			if m is not None:
+				text.append('sketch_' + m.group(1).lower() + '(' + str(calls) + ', ' + ('timestamp' if live else 'NULL') + ', ')
+				calls += 1
+				i += m.end()
+				continue
+		text.append(ch)
+		i += 1
+	return ''.join(text)
+
+
+def query_sql(i, mode='live'):
+	# queries[i] as it's run (see sketch_calls())
+	key = (queries[i], mode)
+	if key not in rewritten_queries: rewritten_queries[key] = sketch_calls(queries[i], mode=='live')
+	return rewritten_queries[key]
+
+
+def start_sketch_run(i, mode='live', bucket=None):
+	# (before each execution of query i, or of each bucket of an incremental query, whose buckets keep
+	# separate states) lets its sketches tell one run from the next and, in live.py, merge only the rows
+	# that came in since the query last ran: from where the last run stopped up to the snapshot's newest
+	# second (left for the next run, as it may still be filling up)
+	global sketch_run_count
+	with sketch_lock:
+		sketch_run_count += 1
+		query_local.sketch_run = sketch_run_count
+	query_local.query_number = i
+	query_local.sketch_bucket = bucket
+	query_local.sketch_rows = (sketch_marks.get(i), sketch_upto) if mode=='live' else None
+	query_local.sketch_error = None
+
+
+def end_sketch_run(i, mode='live'):
+	if mode=='live' and sketch_upto is not None: sketch_marks[i] = sketch_upto
+
+
+def drop_sketches(i, bucket):
+	# (an incremental query's bucket has been evicted)
+	with sketch_lock:
+		for name in [name for name in sketch_states if name[:2]==(i, bucket)]:
+			del sketch_states[name]
+			sketch_finalized.pop(name, None)
+
+
+def sketch_failed(e):
+	# the error a sketch aggregate raised, rather than the sqlite3 one that wraps it
+	if getattr(query_local, 'sketch_error', None) is not None: return ValueError(query_local.sketch_error)
+	return e
+
+
+def sketch_result(function, param, sketch):
+	if function=='approx_distinct':
+		return sketch.estimate()
+	if function=='approx_topk':
+		return json.dumps(sketch.top(param))
+	if function=='approx_quantile':
+		return sketch.quantile(param)
+
+
+class SketchAggregate:
+	# each group's sketch is merged, when the group is finalized, into the state kept for its query, call,
+	# parameter and key across batches (historical.py) or periods (live.py)
+	function = None
+
+	def __init__(self):
+		self.sketch = None
+		self.param = None
+		self.key = ''
+		self.call = None
+
+	def finalize(self):
+		if self.sketch is None: self.sketch = self.new_sketch()
+		i = getattr(query_local, 'query_number', None)
+		run = getattr(query_local, 'sketch_run', None)
+		name = (i, getattr(query_local, 'sketch_bucket', None), self.call, self.function, self.param, self.key)
+		with sketch_lock:
+			if run is not None and sketch_finalized.get(name)==run:
+				# (two groups with one state, like a GROUP BY without a key: the second would get a running total)
+				query_local.sketch_error = ('Query ' + str(i) + ': ' + self.function + '() is finalized for more than one group with key "'
+					+ str(self.key) + '". Pass the GROUP BY column(s) as its key argument, so each group keeps its own state.')
+				raise ValueError(query_local.sketch_error)
+			sketch_finalized[name] = run
+			merged = sketch_states.get(name)
+			if merged is None:
+				sketch_states[name] = merged = self.sketch
+			else:
+				merged.merge(self.sketch)
+			return sketch_result(self.function, self.param, merged)
+
+
+class ApproxDistinct(SketchAggregate):
+	# approx_distinct(x [, key])
+	function = 'approx_distinct'
+
+	def new_sketch(self):
+		return sketches.HyperLogLog()
+
+	def step(self, value, key=''):
+		if self.sketch is None: self.sketch = self.new_sketch()
+		if value is not None: self.sketch.add(value)
+		self.key = key
+
+
+class ApproxTopK(SketchAggregate):
+	# approx_topk(x, k [, key]) -> JSON list of [value, count] pairs
+	function = 'approx_topk'
+
+	def new_sketch(self):
+		return sketches.SpaceSaving(max(100, 10 * (self.param or 10)))
+
+	def step(self, value, k, key=''):
+		if self.sketch is None:
+			self.param = int(k)
+			self.sketch = self.new_sketch()
+		if value is not None: self.sketch.add(value)
+		self.key = key
+
+
+class ApproxQuantile(SketchAggregate):
+	# approx_quantile(x, q [, key])
+	function = 'approx_quantile'
+
+	def new_sketch(self):
+		return sketches.TDigest()
+
+	def step(self, value, q, key=''):
+		if self.sketch is None: self.sketch = self.new_sketch()
+		self.param = float(q)
+		if value is not None:
+			try: self.sketch.add(float(value))
+			except ValueError: pass
+		self.key = key
+
+
+def sketch_call(aggregate):
+	# the sketch_*(call, timestamp, ...) version of an approx_*() aggregate that queries run as (see
+	# sketch_calls()); in live.py, rows outside the run's timestamps are left out of the sketch
+	class SketchCall(aggregate):
+		def step(self, call, timestamp, value, *args):
+			self.call = call
+			rows = getattr(query_local, 'sketch_rows', None)
+			if rows is not None and timestamp is not None and ((rows[0] is not None and timestamp<rows[0]) or (rows[1] is not None and timestamp>=rows[1])):
+				value = None # (merged by an earlier run, or left for the next)
+			aggregate.step(self, value, *args)
+	return SketchCall
+
+
+def register_functions(conn):
+	conn.create_function('ip_text', 1, ip_text, deterministic=True)
+	for name, aggregate, n_args in [('distinct', ApproxDistinct, 1), ('topk', ApproxTopK, 2), ('quantile', ApproxQuantile, 2)]:
+		conn.create_aggregate('approx_' + name, n_args, aggregate)
+		conn.create_aggregate('approx_' + name, n_args + 1, aggregate)
+		conn.create_aggregate('sketch_' + name, n_args + 2, sketch_call(aggregate))
+		conn.create_aggregate('sketch_' + name, n_args + 3, sketch_call(aggregate))
+
+
+def write_sketches():
+	# the merged value of every sketch aggregate so far; after the last batch (or period) these are the final results
+	global output
+	with sketch_lock:
+		rows = [(query_number, bucket, call, function, param, key, sketch_result(function, param, sketch))
+			for (query_number, bucket, call, function, param, key), sketch in sorted(sketch_states.items(), key=lambda x: str(x[0]))]
+	with open(output + 'sketches.csv', 'w') as write_obj:
+		csv_writer = csv.writer(write_obj)
+		csv_writer.writerow(['query', 'bucket', 'call', 'function', 'parameter', 'key', 'value'])
+		for row in rows:
+			csv_writer.writerow(row)
 
 
 def print_db_stats():
-	min_ts = get_db_stat('SELECT MIN(timestamp) FROM logs')
-	if min_ts: min_time = datetime.utcfromtimestamp(min_ts).strftime('%Y-%m-%d %H:%M:%S')
+	n_rows, min_ts, max_ts = db_range()
+	if min_ts is not None: min_time = datetime.utcfromtimestamp(min_ts).strftime('%Y-%m-%d %H:%M:%S')
 	else: min_time = ''
-	max_ts = get_db_stat('SELECT MAX(timestamp) FROM logs')
-	if max_ts: max_time = datetime.utcfromtimestamp(max_ts).strftime('%Y-%m-%d %H:%M:%S')
+	if max_ts is not None: max_time = datetime.utcfromtimestamp(max_ts).strftime('%Y-%m-%d %H:%M:%S')
 	else: max_time = ''
-	n_rows = get_db_stat('SELECT COUNT(*) FROM logs')
 	page_size = get_db_stat('PRAGMA page_size')
 	page_count = get_db_stat('PRAGMA page_count')
 	print("Database is now "+min_time+" to "+max_time+" ("+str(n_rows)+" rows). Memory used ~= "+str(page_size*page_count)+" bytes.")
 
 
+def db_range():
+	# (rows, min timestamp, max timestamp) stored, from db_stats
+	stats = list(db_stats.values())
+	if len(stats)==0: return 0, None, None
+	return sum(s[0] for s in stats), min(s[1] for s in stats), max(s[2] for s in stats)
+
+
+def write_metrics(gauges={}):
+	# appends the metrics as a JSON line to metrics_file or, if it ends in .prom, replaces it with a
+	# Prometheus textfile (for node_exporter's textfile collector)
+	if metrics_file=='': return
+	n_rows, min_ts, max_ts = db_range()
+	values = {'db_rows': n_rows, 'db_min_timestamp': min_ts, 'db_max_timestamp': max_ts,
+		'db_bytes': get_db_stat('PRAGMA page_size') * get_db_stat('PRAGMA page_count'), 'rows_late': n_late}
+	values.update(gauges)
+	with metrics_lock:
+		counters = dict(metrics)
+		per_query = dict((i, dict(m)) for i, m in query_metrics.items())
+	if not metrics_file.endswith('.prom'):
+		record = {'time': round(time.time(), 3)}
+		record.update(counters)
+		record.update(values)
+		record['queries'] = dict((str(i), m) for i, m in sorted(per_query.items()))
+		with open(metrics_file, 'a') as f:
+			f.write(json.dumps(record) + '\n')
+		return
+	lines = []
+	for name, value in sorted(counters.items()):
+		lines.append('# TYPE logservatory_' + name + '_total counter')
+		lines.append('logservatory_' + name + '_total ' + str(value))
+	for name, value in sorted(values.items()):
+		if value is None: continue
+		lines.append('# TYPE logservatory_' + name + ' gauge')
+		lines.append('logservatory_' + name + ' ' + str(value))
+	for name in ['seconds', 'rows', 'runs', 'errors']:
+		lines.append('# TYPE logservatory_query_' + name + '_total counter')
+		for i, m in sorted(per_query.items()):
+			lines.append('logservatory_query_' + name + '_total{query="' + str(i) + '"} ' + str(m.get(name, 0)))
+	with open(metrics_file + '.tmp', 'w') as f:
+		f.write('\n'.join(lines) + '\n')
+	os.replace(metrics_file + '.tmp', metrics_file)
+
+
+def database_state():
+	# what save_checkpoint() needs to know about the database, taken along with the copy of it that's saved
+	return {'format': format, 'schema': data_columns, 'queries': queries,
+		'partitions': sorted(partitions), 'evicted_before': evicted_before, 'n_late': n_late,
+		'db_stats': [[bucket] + stats for bucket, stats in db_stats.items()], 'next_ids': dict(next_ids), 'changed_since': changed_since}
+
+
+def save_checkpoint(mode='live', state={}, database=None):
+	# saves a copy of the database (with the SQLite backup API) and, inside it, what's needed to carry on
+	# from here: the caller's state (like the position in the logs), the committed length of each output,
+	# what's staged (with merge), the sketches and the metrics. It's written next to checkpoint_file and
+	# then renamed over it, so a crash leaves the previous checkpoint intact.
+	# database, if given, is the snapshot the queries ran over (a connection, or serialized), and state
+	# then includes its database_state(): live.py saves it without holding db_lock, so ingestion carries on.
+	global last_checkpoint
+	if checkpoint_file=='': return
+	state = dict(state)
+	if database is None: state.update(database_state())
+	state.update({'mode': mode, 'sketch_marks': sketch_marks})
+	state['outputs'] = {}
+	for i in range(len(queries)):
+		path = output_path(i)
+		if os.path.exists(path): state['outputs'][path] = os.path.getsize(path)
+	state['staged'] = {}
+	if staging is not None:
+		with staging_lock:
+			staging.commit()
+			for (table,) in staging.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall():
+				state['staged'][table] = staging.execute('SELECT COALESCE(MAX(rowid), 0) FROM ' + table).fetchone()[0]
+	with metrics_lock:
+		state['metrics'] = dict(metrics)
+		state['query_metrics'] = dict((i, dict(m)) for i, m in query_metrics.items())
+	with sketch_lock:
+		sketches = pickle.dumps(sketch_states)
+	incremental = pickle.dumps(incremental_results)
+
+	path = checkpoint_file + '.tmp'
+	if os.path.exists(path): os.remove(path)
+	if isinstance(database, bytes):
+		with open(path, 'wb') as write_obj: write_obj.write(database)
+	disk = sqlite3.connect(path)
+	if not isinstance(database, bytes): (connection if database is None else database).backup(disk)
+	disk.execute("CREATE TABLE checkpoint_state (name text primary key, value)")
+	disk.executemany("INSERT INTO checkpoint_state VALUES (?, ?)", [('state', json.dumps(state)), ('sketches', sketches), ('incremental', incremental)])
+	disk.commit()
+	disk.close()
+	os.replace(path, checkpoint_file)
+	last_checkpoint = time.monotonic()
+
+
+def restore_checkpoint(mode='live'):
+	# (with resume, after start_database()) loads the checkpoint's database into connection, truncates the
+	# outputs to their committed lengths, and returns the saved state (also kept in resume_state)
+	global resume_state, partitions, evicted_before, n_late, changed_since
+	disk = sqlite3.connect(checkpoint_file)
+	try:
+		values = dict(disk.execute("SELECT name, value FROM checkpoint_state").fetchall())
+	except sqlite3.DatabaseError:
+		print('Argument "checkpoint" is not a checkpoint file, so there\'s nothing to resume from.')
+		exit()
+	state = json.loads(values['state'])
+	if state['mode']!=mode or state['format']!=format or state['schema']!=data_columns or state['queries']!=queries:
+		print('The checkpoint was saved by a run with a different mode, format, queries or storage options (like "compact"), so it can\'t be resumed.')
+		exit()
+	disk.backup(connection)
+	disk.close()
+	connection.execute("DROP TABLE checkpoint_state")
+	connection.commit()
+
+	partitions = dict((bucket, 'logs_' + str(bucket)) for bucket in state['partitions'])
+	evicted_before = state['evicted_before']
+	n_late = state['n_late']
+	changed_since = state['changed_since']
+	db_stats.clear()
+	for bucket, rows, min_ts, max_ts in state['db_stats']: db_stats[bucket] = [rows, min_ts, max_ts]
+	for name in dictionaries:
+		dictionaries[name] = dict((value, id) for id, value in connection.execute("SELECT id, value FROM dict_" + name))
+		next_ids[name] = state['next_ids'][name]
+	metrics.update(state['metrics'])
+	for i, m in state['query_metrics'].items(): query_metrics[int(i)].update(m)
+	with sketch_lock:
+		sketch_states.clear()
+		sketch_states.update(pickle.loads(values['sketches']))
+		for i, mark in state['sketch_marks'].items(): sketch_marks[int(i)] = mark
+	incremental_results.update(pickle.loads(values['incremental']))
+	if mode=='static':
+		# (live outputs are rewritten every period anyway)
+		for i in range(len(queries)):
+			path = output_path(i)
+			if os.path.exists(path):
+				with open(path, 'r+b') as f: f.truncate(state['outputs'].get(path, 0))
+	resume_state = state
+	return state
+
+
 def get_db_stat(q):
 	global connection
 	cur = connection.cursor()
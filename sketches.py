@@ -0,0 +1,160 @@
+import math, hashlib
+
+# Mergeable summaries behind the approx_*() SQL aggregates. Each one can be built over a single
+# memory-batch and then merged with the summaries of other batches, so results cover the whole run.
+
+
+def hash64(value):
+	# stable across processes and runs (unlike hash()), so merged state can be saved and restored
+	return int.from_bytes(hashlib.blake2b(str(value).encode('utf-8', 'surrogatepass'), digest_size=8).digest(), 'big')
+
+
+class HyperLogLog:
+	# distinct counts; registers stay sparse (a dict) until enough of them are set, so small
+	# groups in a GROUP BY stay small
+	def __init__(self, precision=14):
+		self.precision = precision
+		self.m = 1 << precision
+		self.sparse = {}
+		self.registers = None
+
+	def add(self, value):
+		h = hash64(value)
+		index = h >> (64 - self.precision)
+		rank = 64 - self.precision - (h & ((1 << (64 - self.precision)) - 1)).bit_length() + 1
+		if self.registers is not None:
+			if rank>self.registers[index]: self.registers[index] = rank
+		elif rank>self.sparse.get(index, 0):
+			self.sparse[index] = rank
+			if len(self.sparse)>self.m // 4: self.densify()
+
+	def densify(self):
+		self.registers = bytearray(self.m)
+		for index, rank in self.sparse.items():
+			self.registers[index] = rank
+		self.sparse = {}
+
+	def merge(self, other):
+		if other.registers is not None and self.registers is None:
+			self.densify()
+		if self.registers is not None:
+			if other.registers is not None:
+				self.registers = bytearray(map(max, self.registers, other.registers))
+			else:
+				for index, rank in other.sparse.items():
+					if rank>self.registers[index]: self.registers[index] = rank
+		else:
+			for index, rank in other.sparse.items():
+				if rank>self.sparse.get(index, 0): self.sparse[index] = rank
+			if len(self.sparse)>self.m // 4: self.densify()
+
+	def estimate(self):
+		if self.registers is not None:
+			zeros = self.registers.count(0)
+			total = sum(2.0 ** -r for r in self.registers)
+		else:
+			zeros = self.m - len(self.sparse)
+			total = zeros + sum(2.0 ** -r for r in self.sparse.values())
+		alpha = 0.7213 / (1 + 1.079 / self.m)
+		e = alpha * self.m * self.m / total
+		if e<=2.5 * self.m and zeros>0:
+			e = self.m * math.log(self.m / zeros) # linear counting for small cardinalities
+		return int(round(e))
+
+
+class SpaceSaving:
+	# top-K heavy hitters; counts are over-estimates by at most floor. Counters are trimmed back to
+	# capacity lazily (when there are twice as many), which keeps the per-row cost to a dict update.
+	def __init__(self, capacity=100):
+		self.capacity = capacity
+		self.counts = {}
+		self.floor = 0
+
+	def add(self, item, count=1):
+		c = self.counts.get(item)
+		if c is None:
+			self.counts[item] = self.floor + count
+			if len(self.counts)>2 * self.capacity: self.trim()
+		else:
+			self.counts[item] = c + count
+
+	def trim(self):
+		items = sorted(self.counts.items(), key=lambda x: x[1], reverse=True)
+		if len(items)>self.capacity:
+			self.floor = max(self.floor, items[self.capacity][1])
+			self.counts = dict(items[:self.capacity])
+
+	def merge(self, other):
+		for item, c in self.counts.items():
+			if item not in other.counts: self.counts[item] = c + other.floor
+		for item, c in other.counts.items():
+			self.counts[item] = self.counts.get(item, self.floor) + c
+		self.floor += other.floor
+		if len(self.counts)>self.capacity: self.trim()
+
+	def top(self, k):
+		return sorted(self.counts.items(), key=lambda x: (-x[1], str(x[0])))[:k]
+
+
+class TDigest:
+	# quantiles; a merging t-digest with the 4q(1-q) size bound, so centroids are small in the tails
+	def __init__(self, compression=100):
+		self.compression = compression
+		self.centroids = [] # sorted [mean, weight] pairs
+		self.buffer = []
+		self.min = None
+		self.max = None
+
+	def add(self, x):
+		self.buffer.append(x)
+		if len(self.buffer)>=10 * self.compression: self.compress()
+
+	def compress(self):
+		if len(self.buffer)>0:
+			lo, hi = min(self.buffer), max(self.buffer)
+			if self.min is None or lo<self.min: self.min = lo
+			if self.max is None or hi>self.max: self.max = hi
+		points = sorted(self.centroids + [[x, 1] for x in self.buffer])
+		self.buffer = []
+		if len(points)==0: return
+		total = sum(w for m, w in points)
+		merged = []
+		mean, weight = points[0]
+		so_far = 0
+		for m, w in points[1:]:
+			q = (so_far + weight + w / 2.0) / total
+			if weight + w<=4 * total * q * (1 - q) / self.compression:
+				weight += w
+				mean += (m - mean) * w / weight
+			else:
+				merged.append([mean, weight])
+				so_far += weight
+				mean, weight = m, w
+		merged.append([mean, weight])
+		self.centroids = merged
+
+	def merge(self, other):
+		other.compress()
+		self.centroids = self.centroids + [list(c) for c in other.centroids]
+		self.centroids.sort()
+		if other.min is not None and (self.min is None or other.min<self.min): self.min = other.min
+		if other.max is not None and (self.max is None or other.max>self.max): self.max = other.max
+		self.compress()
+
+	def quantile(self, q):
+		self.compress()
+		if len(self.centroids)==0: return None
+		if len(self.centroids)==1: return self.centroids[0][0]
+		total = sum(w for m, w in self.centroids)
+		target = q * total
+		cumulative = 0
+		previous = (self.min, 0)
+		for m, w in self.centroids:
+			center = cumulative + w / 2.0
+			if target<center:
+				if center==previous[1]: return m
+				return previous[0] + (m - previous[0]) * (target - previous[1]) / (center - previous[1])
+			previous = (m, center)
+			cumulative += w
+		if total==previous[1]: return self.max
+		return previous[0] + (self.max - previous[0]) * (target - previous[1]) / (total - previous[1])
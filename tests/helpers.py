@@ -0,0 +1,42 @@
+import os, sys, csv, time, subprocess
+
+# shared by the tests that run historical.py and live.py on small generated logs
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+start_ts = 1600000000 # 2020-09-13 12:26:40
+
+
+def ncsa_line(ts, ip, verb, url, status):
+	return '%s - - [%s +0000] "%s %s HTTP/1.1" %d 100\n' % (ip, time.strftime('%d/%b/%Y:%H:%M:%S', time.gmtime(ts)), verb, url, status)
+
+
+def log_lines(n, start=start_ts):
+	# one line a second: 1 in 4 requests are 404s, 1 in 3 are POSTs, IPs repeat every 50 lines, URLs every 7
+	return [ncsa_line(start + i, '10.0.0.%d' % (i % 50), 'POST' if i % 3==0 else 'GET', '/page%d' % (i % 7), 404 if i % 4==0 else 200)
+		for i in range(n)]
+
+
+def write_queries(path, queries):
+	with open(path, 'w') as f: f.write('\n##########\n'.join(queries) + '\n')
+
+
+def read_csv(path):
+	with open(path) as f: return list(csv.reader(f))
+
+
+def historical(tmp_path, queries, lines, options=[], name='out'):
+	# runs historical.py over lines (written to one log file, indexed once) and returns the process and
+	# the output directory
+	logs = tmp_path / 'logs'
+	if not logs.exists():
+		logs.mkdir()
+		(logs / 'a.log').write_text(''.join(lines))
+		index = subprocess.run([sys.executable, os.path.join(root, 'build-index.py'), '--input', str(logs) + '/', '--format', 'ncsa-common'],
+			capture_output=True, text=True, check=True).stdout
+		(tmp_path / 'index.csv').write_text(index)
+	write_queries(tmp_path / (name + '.sql'), queries)
+	output = tmp_path / name
+	output.mkdir()
+	run = subprocess.run([sys.executable, os.path.join(root, 'historical.py'), '--index', str(tmp_path / 'index.csv'), '--format', 'ncsa-common',
+		'--queries', str(tmp_path / (name + '.sql')), '--output', str(output) + '/'] + options, capture_output=True, text=True, cwd=str(tmp_path))
+	return run, output
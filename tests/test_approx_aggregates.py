@@ -0,0 +1,53 @@
+import os, sys, json, time, subprocess
+from helpers import root, start_ts, log_lines, write_queries, read_csv
+from helpers import historical as run_historical
+
+
+def historical(tmp_path, queries, n=8000, memory=1000000):
+	return run_historical(tmp_path, queries, log_lines(n), ['--memory', str(memory)])[0]
+
+
+def test_two_calls_keep_separate_states(tmp_path):
+	# (a small memory limit, so the state is merged over several batches)
+	run = historical(tmp_path, ['SELECT approx_distinct(request_ip), approx_distinct(request_url), COUNT(*) FROM logs'], memory=200000)
+	assert run.returncode==0, run.stderr
+	rows = read_csv(tmp_path / 'out' / 'query0.csv')
+	assert [row[:2] for row in rows]==[['50', '7']] * len(rows)
+	assert len(rows)>1
+
+
+def test_group_by_without_key_fails(tmp_path):
+	run = historical(tmp_path, ['SELECT timestamp/3600 AS h, approx_distinct(request_ip) FROM logs GROUP BY h'])
+	assert run.returncode!=0
+	assert 'Pass the GROUP BY column(s) as its key argument' in run.stderr
+
+
+def test_group_by_with_key(tmp_path):
+	run = historical(tmp_path, ['SELECT timestamp/3600 AS h, approx_topk(request_status_code, 1, timestamp/3600), COUNT(*) FROM logs GROUP BY h'])
+	assert run.returncode==0, run.stderr
+	final = dict((row[5], row[6]) for row in read_csv(tmp_path / 'out' / 'sketches.csv')[1:])
+	exact = {}
+	for i in range(8000):
+		if i % 4: exact[str((start_ts + i) // 3600)] = exact.get(str((start_ts + i) // 3600), 0) + 1
+	assert dict((h, json.loads(value)[0][1]) for h, value in final.items())==exact
+
+
+def test_live_counts_each_row_once(tmp_path):
+	write_queries(tmp_path / 'queries.sql', ['SELECT approx_topk(request_status_code, 2), approx_quantile(timestamp, 0.0), COUNT(*) FROM logs'])
+	output = tmp_path / 'out'
+	output.mkdir()
+	live = subprocess.Popen([sys.executable, os.path.join(root, 'live.py'), '--format', 'ncsa-common', '--queries', str(tmp_path / 'queries.sql'),
+		'--output', str(output) + '/', '--period', '1', '--buffer', '100'], stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, cwd=str(tmp_path))
+	lines = log_lines(4000)
+	for i in range(0, len(lines), 1000):
+		live.stdin.write(''.join(lines[i:i + 1000]))
+		live.stdin.flush()
+		time.sleep(1.5) # (so the queries run several times over rows that are still retained)
+	live.stdin.close()
+	stdout = live.stdout.read()
+	assert live.wait(timeout=60)==0
+	assert stdout.count('Queries took')>=3
+	rows = read_csv(output / 'query0.csv')
+	assert json.loads(rows[0][0])==[[200, 3000], [404, 1000]]
+	assert float(rows[0][1])==start_ts
+	assert rows[0][2]=='4000'
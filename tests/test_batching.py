@@ -0,0 +1,61 @@
+import os, sys, time, signal, subprocess
+from helpers import root, log_lines, write_queries, read_csv, historical
+
+# results over several memory-batches (with --window, or resumed from a checkpoint) match one unbatched run
+
+lines = log_lines(20000)
+
+
+def test_window_matches_unbatched(tmp_path):
+	query = 'SELECT timestamp/600 AS w, request_verb, COUNT(*), COUNT(DISTINCT request_ip), MAX(timestamp) FROM logs GROUP BY w, request_verb'
+	windowed, output = historical(tmp_path, [query], lines, ['--window', '600', '--memory', '300000'], 'windowed')
+	assert windowed.returncode==0, windowed.stderr
+	assert windowed.stdout.count('Database is now')>1
+	unbatched, unbatched_output = historical(tmp_path, [query], lines, [], 'unbatched')
+	rows = read_csv(output / 'query0.csv')
+	assert sorted(rows)==sorted(read_csv(unbatched_output / 'query0.csv'))
+	assert len(rows)>0 and len(set((row[0], row[1]) for row in rows))==len(rows)
+
+
+def test_window_holds_back_whole_windows_only(tmp_path):
+	# (a window bigger than a batch can't be held back: the batch is queried as it is)
+	query = 'SELECT timestamp/86400 AS d, COUNT(*) FROM logs GROUP BY d'
+	run, output = historical(tmp_path, [query], lines, ['--window', '86400', '--memory', '300000'], 'windowed')
+	assert run.returncode==0, run.stderr
+	assert sum(int(row[1]) for row in read_csv(output / 'query0.csv'))==len(lines)
+
+
+def test_historical_resumes_from_checkpoint(tmp_path):
+	query = 'SELECT request_url, request_status_code, COUNT(*) FROM logs GROUP BY request_url, request_status_code'
+	historical(tmp_path, [query], log_lines(60000), [], 'unbatched')
+	write_queries(tmp_path / 'resumed.sql', [query])
+	output = tmp_path / 'resumed'
+	output.mkdir()
+	checkpoint = tmp_path / 'checkpoint.sqlite'
+	args = [sys.executable, os.path.join(root, 'historical.py'), '--index', str(tmp_path / 'index.csv'), '--format', 'ncsa-common', '--queries',
+		str(tmp_path / 'resumed.sql'), '--output', str(output) + '/', '--memory', '200000', '--merge', '--checkpoint', str(checkpoint)]
+	# (killed once a checkpoint is saved, part way through)
+	p = subprocess.Popen(args, stdout=subprocess.DEVNULL)
+	while not checkpoint.exists() and p.poll() is None: time.sleep(0.01)
+	time.sleep(0.2)
+	p.send_signal(signal.SIGKILL)
+	assert p.wait()==-signal.SIGKILL
+	resumed = subprocess.run(args + ['--resume'], capture_output=True, text=True)
+	assert resumed.returncode==0, resumed.stderr
+	assert not checkpoint.exists()
+	assert sorted(read_csv(output / 'query0.csv'))==sorted(read_csv(tmp_path / 'unbatched' / 'query0.csv'))
+
+
+def test_live_resumes_from_checkpoint(tmp_path):
+	write_queries(tmp_path / 'queries.sql', ['SELECT request_status_code, COUNT(*), approx_distinct(request_ip, request_status_code) FROM logs GROUP BY request_status_code ORDER BY 1'])
+	args = [sys.executable, os.path.join(root, 'live.py'), '--format', 'ncsa-common', '--queries', str(tmp_path / 'queries.sql'), '--period', '1']
+	lines = log_lines(4000)
+	checkpoint = ['--checkpoint', str(tmp_path / 'checkpoint.sqlite')]
+	# (all the lines in one run, then half of them, and the rest resumed from its final checkpoint)
+	for name, part, options in [('whole', lines, []), ('resumed', lines[:2000], checkpoint), ('resumed', lines[2000:], checkpoint + ['--resume'])]:
+		output = tmp_path / name
+		output.mkdir(exist_ok=True)
+		run = subprocess.run(args + ['--output', str(output) + '/'] + options, input=''.join(part), capture_output=True, text=True)
+		assert run.returncode==0, run.stderr
+		assert 'failed' not in run.stdout
+	assert read_csv(tmp_path / 'resumed' / 'query0.csv')==read_csv(tmp_path / 'whole' / 'query0.csv')==[['200', '3000', '50'], ['404', '1000', '25']]
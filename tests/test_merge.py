@@ -0,0 +1,44 @@
+import pytest
+from helpers import log_lines, read_csv, historical
+
+# --merge over several small batches should give what one batch holding everything gives
+
+lines = log_lines(20000)
+
+
+def batched_and_unbatched(tmp_path, query, memory=300000):
+	batched, output = historical(tmp_path, [query], lines, ['--merge', '--memory', str(memory)], 'batched')
+	assert batched.returncode==0, batched.stdout + batched.stderr
+	assert batched.stdout.count('Database is now')>1
+	unbatched, unbatched_output = historical(tmp_path, [query], lines, [], 'unbatched')
+	assert unbatched.returncode==0, unbatched.stderr
+	return read_csv(output / 'query0.csv'), read_csv(unbatched_output / 'query0.csv')
+
+
+@pytest.mark.parametrize('query', [
+	'SELECT request_url, request_verb, COUNT(*), SUM(sent_bytes), MIN(timestamp), MAX(timestamp) FROM logs GROUP BY request_url, request_verb',
+	'SELECT request_url, COUNT(request_status_code), AVG(request_status_code) FROM logs GROUP BY request_url',
+])
+def test_merge_matches_unbatched(tmp_path, query):
+	merged, unbatched = batched_and_unbatched(tmp_path, query)
+	assert sorted(merged)==sorted(unbatched)
+
+
+def test_merge_keeps_order_by(tmp_path):
+	merged, unbatched = batched_and_unbatched(tmp_path, 'SELECT request_ip, COUNT(*) AS n FROM logs WHERE request_status_code=404 GROUP BY request_ip ORDER BY n DESC, 1', 100000)
+	assert merged==unbatched
+
+
+@pytest.mark.parametrize('query', [
+	'SELECT request_url, request_verb FROM logs GROUP BY request_url, request_verb',
+	'#merge: key\nSELECT DISTINCT request_url FROM logs ORDER BY request_url',
+])
+def test_merge_keeps_each_group_once(tmp_path, query):
+	merged, unbatched = batched_and_unbatched(tmp_path, query)
+	assert sorted(merged)==sorted(unbatched)
+	assert len(set(map(tuple, merged)))==len(merged)
+
+
+def test_merge_needs_count_of_the_same_expression_for_avg(tmp_path):
+	run, output = historical(tmp_path, ['SELECT request_url, COUNT(*), AVG(sent_bytes) FROM logs GROUP BY request_url'], lines, ['--merge'])
+	assert '"#merge:" line' in run.stdout
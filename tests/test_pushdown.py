@@ -0,0 +1,44 @@
+import pytest
+from helpers import start_ts, ncsa_line, log_lines, read_csv, historical
+
+# queries give the same rows whether or not columns are pruned and WHERE conditions pushed down to the parser
+
+lines = log_lines(3000) + [ncsa_line(start_ts + 3000, '10.0.0.1', 'POST', '/x', 200), ncsa_line(start_ts + 3001, '10.0.0.2', 'get', '/Page1', 200)]
+
+
+def pruned_and_unpruned(tmp_path, queries):
+	results = []
+	for name, options in [('pruned', []), ('unpruned', ['--no-prune'])]:
+		run, output = historical(tmp_path, queries, lines, options, name)
+		assert run.returncode==0, run.stderr
+		results.append([sorted(map(tuple, read_csv(output / ('query' + str(i) + '.csv')))) for i in range(len(queries))])
+	return results
+
+
+def test_or_is_not_pushed_down(tmp_path):
+	query = "SELECT request_verb, request_url, request_status_code FROM logs WHERE request_status_code='404' AND request_verb='GET' OR request_url='/x'"
+	pruned, unpruned = pruned_and_unpruned(tmp_path, [query])
+	assert pruned==unpruned
+	assert ('POST', '/x', '200') in pruned[0]
+
+
+@pytest.mark.parametrize('query', [
+	"SELECT request_url, COUNT(*) FROM logs WHERE request_status_code=404 GROUP BY request_url",
+	"SELECT request_ip, request_url FROM logs WHERE request_verb='POST' AND request_url LIKE '/page_'",
+	"SELECT request_url, COUNT(*) FROM logs WHERE request_url LIKE '/PAGE1%' GROUP BY request_url",
+	"SELECT request_verb, COUNT(*) FROM logs WHERE request_status_code='200' AND NOT request_verb='GET' GROUP BY request_verb",
+	"SELECT request_url, COUNT(*) FROM logs WHERE request_verb='GET' AND (request_url='/page1' OR request_status_code=404) GROUP BY request_url",
+	"SELECT * FROM logs WHERE request_url='/x'",
+])
+def test_pushdown_gives_the_same_rows(tmp_path, query):
+	pruned, unpruned = pruned_and_unpruned(tmp_path, [query])
+	assert pruned==unpruned
+	assert len(pruned[0])>0
+
+
+def test_condition_only_some_queries_have(tmp_path):
+	# (only conditions every query has are pushed down)
+	queries = ["SELECT COUNT(*) FROM logs WHERE request_status_code=404", "SELECT COUNT(*) FROM logs WHERE request_verb='POST'"]
+	pruned, unpruned = pruned_and_unpruned(tmp_path, queries)
+	assert pruned==unpruned
+	assert pruned==[[('750',)], [('1001',)]]
@@ -0,0 +1,74 @@
+import os, sys, random, pickle
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import sketches
+
+
+def test_hyperloglog_estimate():
+	for n in [10, 1000, 100000]:
+		hll = sketches.HyperLogLog()
+		for i in range(n): hll.add('ip' + str(i))
+		assert abs(hll.estimate() - n) <= max(1, 0.03 * n)
+
+
+def test_hyperloglog_merge_matches_one_sketch():
+	a, b, both = sketches.HyperLogLog(), sketches.HyperLogLog(), sketches.HyperLogLog()
+	for i in range(50000):
+		(a if i % 2 else b).add(i % 30000)
+		both.add(i % 30000)
+	a.merge(b)
+	assert a.estimate()==both.estimate()
+	# (sparse into dense, and dense into sparse)
+	small = sketches.HyperLogLog()
+	small.add('x')
+	small.merge(a)
+	assert abs(small.estimate() - both.estimate())<=0.01 * both.estimate()
+	a.merge(small)
+	assert abs(a.estimate() - both.estimate())<=0.01 * both.estimate()
+
+
+def test_hyperloglog_survives_pickle():
+	hll = sketches.HyperLogLog()
+	for i in range(1000): hll.add(i)
+	assert pickle.loads(pickle.dumps(hll)).estimate()==hll.estimate()
+
+
+def test_spacesaving_exact_under_capacity():
+	ss = sketches.SpaceSaving(10)
+	for item, n in [('a', 5), ('b', 3), ('c', 1)]:
+		for i in range(n): ss.add(item)
+	assert ss.top(2)==[('a', 5), ('b', 3)]
+
+
+def test_spacesaving_heavy_hitters_and_merge():
+	rng = random.Random(1)
+	a, b = sketches.SpaceSaving(100), sketches.SpaceSaving(100)
+	exact = {}
+	for i in range(20000):
+		item = 'hot' + str(i % 5) if i % 2 else 'cold' + str(rng.randrange(5000))
+		(a if rng.random()<0.5 else b).add(item)
+		exact[item] = exact.get(item, 0) + 1
+	a.merge(b)
+	top = a.top(5)
+	assert sorted(item for item, c in top)==['hot' + str(i) for i in range(5)]
+	for item, c in top:
+		# (over-estimates, by at most floor)
+		assert exact[item]<=c<=exact[item] + a.floor
+
+
+def test_tdigest_quantiles():
+	rng = random.Random(2)
+	values = [rng.random() * 1000 for i in range(20000)]
+	digest = sketches.TDigest()
+	for x in values: digest.add(x)
+	values.sort()
+	for q in [0.01, 0.5, 0.99]:
+		assert abs(digest.quantile(q) - values[int(q * len(values))])<10
+	assert sketches.TDigest().quantile(0.5) is None
+
+
+def test_tdigest_merge():
+	a, b = sketches.TDigest(), sketches.TDigest()
+	for i in range(10000): (a if i<5000 else b).add(float(i))
+	a.merge(b)
+	assert abs(a.quantile(0.5) - 5000)<100
+	assert a.quantile(0)==0 and a.quantile(1)==9999